@@ -0,0 +1,75 @@
+"""embeddings_json_to_float32_blob
+
+Revision ID: a3e8c5d1f7b4
+Revises: b71d5f4a9c2e
+Create Date: 2026-10-16 10:30:00.000000
+
+"""
+import json
+from typing import Sequence, Union
+
+import numpy as np
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a3e8c5d1f7b4"
+down_revision: Union[str, Sequence[str], None] = "b71d5f4a9c2e"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (table, primary key, embedding column)
+_EMBEDDING_COLUMNS = (
+    ("memory_facts", "id", "embedding"),
+    ("user_profiles", "user_id", "profile_embedding"),
+)
+
+
+def upgrade() -> None:
+    """Rewrite legacy JSON embeddings as packed float32 BLOBs in place."""
+    bind = op.get_bind()
+    for table, pk, column in _EMBEDDING_COLUMNS:
+        rows = bind.execute(
+            sa.text(f"SELECT {pk}, {column} FROM {table} WHERE typeof({column}) = 'text'")
+        ).fetchall()
+        updates = []
+        for row_id, value in rows:
+            try:
+                arr = np.asarray(json.loads(value), dtype=np.float32)
+            except (TypeError, ValueError):
+                continue  # left as-is; readers already skip undecodable rows
+            # "null", "[]", scalars and nested lists are not embeddings
+            blob = arr.tobytes() if arr.ndim == 1 and arr.size else None
+            updates.append({"row_id": row_id, "blob": blob})
+        if updates:
+            bind.execute(
+                sa.text(f"UPDATE {table} SET {column} = :blob WHERE {pk} = :row_id"),
+                updates,
+            )
+
+
+def downgrade() -> None:
+    """Turn float32 BLOB embeddings back into JSON text."""
+    bind = op.get_bind()
+    for table, pk, column in _EMBEDDING_COLUMNS:
+        rows = bind.execute(
+            sa.text(f"SELECT {pk}, {column} FROM {table} WHERE typeof({column}) = 'blob'")
+        ).fetchall()
+        updates = [
+            {
+                "row_id": row_id,
+                # A length that isn't a multiple of 4 was never a float32 vector
+                "text": (
+                    None
+                    if len(value) % 4
+                    else json.dumps(np.frombuffer(value, dtype=np.float32).tolist())
+                ),
+            }
+            for row_id, value in rows
+        ]
+        if updates:
+            bind.execute(
+                sa.text(f"UPDATE {table} SET {column} = :text WHERE {pk} = :row_id"),
+                updates,
+            )
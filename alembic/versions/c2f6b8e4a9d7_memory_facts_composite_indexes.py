@@ -0,0 +1,58 @@
+"""memory_facts_composite_indexes
+
+Revision ID: c2f6b8e4a9d7
+Revises: a3e8c5d1f7b4
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c2f6b8e4a9d7"
+down_revision: Union[str, Sequence[str], None] = "a3e8c5d1f7b4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Cover the owner + is_active filters and the updated_at ordering used by
+    # fact listing; they supersede the (scope, user_id) / (scope, chat_id) ones.
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_memory_facts_user_active "
+        "ON memory_facts(scope, user_id, is_active, updated_at)"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_memory_facts_chat_active "
+        "ON memory_facts(scope, chat_id, is_active, updated_at)"
+    )
+    op.execute("DROP INDEX IF EXISTS idx_memory_facts_scope_user")
+    op.execute("DROP INDEX IF EXISTS idx_memory_facts_scope_chat")
+    # Nearly every row is active, so this one only steered the planner away
+    # from the owner indexes above.
+    op.execute("DROP INDEX IF EXISTS idx_memory_facts_active")
+    # Member lookups by chat (get_chat_members, fact search) otherwise scan the
+    # (user_id, chat_id) primary key.
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_memberships_chat "
+        "ON chat_memberships(chat_id, user_id)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP INDEX IF EXISTS idx_chat_memberships_chat")
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_memory_facts_active ON memory_facts(is_active)"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_memory_facts_scope_chat ON memory_facts(scope, chat_id)"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_memory_facts_scope_user ON memory_facts(scope, user_id)"
+    )
+    op.execute("DROP INDEX IF EXISTS idx_memory_facts_chat_active")
+    op.execute("DROP INDEX IF EXISTS idx_memory_facts_user_active")
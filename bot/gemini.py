@@ -3,6 +3,15 @@ import os
 from google import genai
 from google.genai import types
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson is a faster drop-in for decoding model output; its JSONDecodeError
+# subclasses json.JSONDecodeError, so callers keep catching the stdlib type.
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 SYSTEM_PROMPT = (
     "You are a helpful assistant in a Telegram group chat. "
     "Keep your responses short and conversational — maximum 3 to 5 sentences. "
@@ -22,12 +31,32 @@ SYSTEM_PROMPT = (
     "Do NOT wrap the JSON in markdown code fences. Output raw JSON only."
 )
 
+# A user's extracted facts, in the shape _normalize_facts validates.
+_FACT_LIST_SCHEMA = types.Schema(
+    type=types.Type.ARRAY,
+    items=types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "fact": types.Schema(type=types.Type.STRING),
+            "importance": types.Schema(type=types.Type.NUMBER),
+            "confidence": types.Schema(type=types.Type.NUMBER),
+            "scope": types.Schema(type=types.Type.STRING, enum=["user", "chat"]),
+        },
+        required=["fact", "importance", "confidence", "scope"],
+    ),
+)
+
 
 class GeminiClient:
     def __init__(self, api_key: str):
         self._client = genai.Client(api_key=api_key)
         self._model = os.getenv("GEMINI_MODEL", "gemini-3-flash-preview")
         self._embedding_model = os.getenv("GEMINI_EMBEDDING_MODEL", "gemini-embedding-001")
+        # The chat config (search tool + system prompt) never varies per call
+        self._ask_config = types.GenerateContentConfig(
+            tools=[types.Tool(google_search=types.GoogleSearch())],
+            system_instruction=SYSTEM_PROMPT,
+        )
 
     def ask(
         self,
@@ -65,49 +94,29 @@ class GeminiClient:
             )
         context_prefix = "\n\n".join(context_parts)
 
-        # Build the structured contents list from history turns.
-        contents: list[types.Content] = []
-        for i, entry in enumerate(history):
-            author = entry.get("author") or ("bot" if entry["role"] == "model" else "user")
-            text = f"[{author}]: {entry['text']}"
-            
-            # Prepend context to the very first user turn so the model sees it
-            # before any history, without creating an extra artificial turn.
-            if i == 0 and context_prefix and entry["role"] == "user":
-                text = f"{context_prefix}\n\n{text}"
-            contents.append(
-                types.Content(
-                    role=entry["role"],
-                    parts=[types.Part(text=text)],
-                )
-            )
+        # Resolve every turn to (role, text) first so the Content objects are
+        # built in one pass with the final list size known up front.
+        turns = [(entry["role"], _format_history_turn(entry)) for entry in history]
+        if context_prefix:
+            if turns and turns[0][0] == "user":
+                # Prepend context to the very first user turn so the model sees it
+                # before any history, without creating an extra artificial turn.
+                turns[0] = ("user", f"{context_prefix}\n\n{turns[0][1]}")
+            else:
+                # History is empty or starts with a model turn: inject the context
+                # as a leading user message so it still reaches the model.
+                turns = [("user", context_prefix), *turns]
 
-        # If context exists but history is empty (or starts with a model turn),
-        # inject it as a leading user message so it still reaches the model.
-        if context_prefix and (not contents or contents[0].role != "user"):
-            contents.insert(
-                0,
-                types.Content(
-                    role="user",
-                    parts=[types.Part(text=context_prefix)],
-                ),
-            )
-
-        # Append the current question as the final user turn.
-        contents.append(
-            types.Content(
-                role="user",
-                parts=[types.Part(text=question)],
-            )
-        )
+        # The current question is always the final user turn.
+        contents = [
+            types.Content(role=role, parts=[types.Part(text=text)])
+            for role, text in (*turns, ("user", question))
+        ]
 
         response = self._client.models.generate_content(
             model=self._model,
             contents=contents,
-            config=types.GenerateContentConfig(
-                tools=[types.Tool(google_search=types.GoogleSearch())],
-                system_instruction=SYSTEM_PROMPT,
-            ),
+            config=self._ask_config,
         )
         raw = response.text
         if raw is None:
@@ -176,37 +185,94 @@ class GeminiClient:
         text = (response.text or "").strip()
         if not text:
             return []
-        if text.startswith("```"):
-            text = text.split("```")[1]
-            if text.startswith("json"):
-                text = text[4:]
-            text = text.strip()
         try:
-            data = json.loads(text)
+            data = _loads_model_json(text)
             if not isinstance(data, list):
                 return []
-            valid_facts: list[dict] = []
-            for item in data:
-                if not isinstance(item, dict):
-                    continue
-                fact_text = str(item.get("fact", "")).strip()
-                if not fact_text:
-                    continue
-                scope = item.get("scope", "user")
-                if scope not in {"user", "chat"}:
-                    scope = "user"
-                valid_facts.append(
-                    {
-                        "fact": fact_text,
-                        "importance": float(item.get("importance", 0.5)),
-                        "confidence": float(item.get("confidence", 0.8)),
-                        "scope": scope,
-                    }
-                )
-            return valid_facts
+            return _normalize_facts(data)
         except (json.JSONDecodeError, TypeError, ValueError):
             return []
 
+    def extract_facts_batch(
+        self,
+        users: list[tuple[int, str, list[str]]],
+        recent_history: str,
+    ) -> dict[int, list[dict]]:
+        """Extract memory facts for several users of one chat in a single call.
+
+        Args:
+            users: List of ``(user_id, user_name, existing_facts)`` tuples.
+            recent_history: The shared chat transcript the facts come from.
+
+        Returns:
+            Mapping of ``user_id`` to the facts extracted for that user. Users
+            the model returned nothing valid for are omitted.
+        """
+        if not users:
+            return {}
+
+        users_block = "\n\n".join(
+            f"User id={user_id} name='{user_name}'\nExisting facts:\n"
+            + ("\n".join(f"- {fact}" for fact in existing_facts) or "(none)")
+            for user_id, user_name, existing_facts in users
+        )
+        prompt = (
+            "You are extracting persistent memory facts for several users of one chat.\n\n"
+            f"{users_block}\n\n"
+            f"Recent conversation:\n{recent_history}\n\n"
+            "Return ONLY a JSON object that maps each user id (as a string) to a JSON array of objects. "
+            "Each object must be:\n"
+            '{"fact":"...", "importance":0.0-1.0, "confidence":0.0-1.0, "scope":"user"|"chat"}\n\n'
+            "Rules:\n"
+            "1. Include only stable or reusable facts (preferences, enduring traits, recurring constraints, long-term chat conventions).\n"
+            "2. Skip temporary details, emotions of the moment, and one-off tasks.\n"
+            "3. Keep each fact short and atomic, and attribute it only to the user it is about.\n"
+            "4. Emit an empty array [] for users with no good new facts.\n"
+            "5. Do not output markdown, prose, or explanations."
+        )
+        response = self._client.models.generate_content(
+            model=self._model,
+            contents=prompt,
+            config=types.GenerateContentConfig(
+                system_instruction=(
+                    "You are a strict memory extraction system. "
+                    "Output valid JSON only."
+                ),
+                response_mime_type="application/json",
+                response_schema=types.Schema(
+                    type=types.Type.OBJECT,
+                    properties={str(user_id): _FACT_LIST_SCHEMA for user_id, _, _ in users},
+                    required=[str(user_id) for user_id, _, _ in users],
+                ),
+            ),
+        )
+        text = (response.text or "").strip()
+        if not text:
+            return {}
+        try:
+            data = _loads_model_json(text)
+        except (json.JSONDecodeError, TypeError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+
+        known_ids = {user_id for user_id, _, _ in users}
+        results: dict[int, list[dict]] = {}
+        for key, items in data.items():
+            try:
+                user_id = int(key)
+            except (TypeError, ValueError):
+                continue
+            if user_id not in known_ids or not isinstance(items, list):
+                continue
+            try:
+                facts = _normalize_facts(items)
+            except (TypeError, ValueError):
+                continue
+            if facts:
+                results[user_id] = facts
+        return results
+
     def decide_fact_action(
         self,
         candidate_fact: str,
@@ -252,13 +318,8 @@ class GeminiClient:
         text = (response.text or "").strip()
         if not text:
             return {"action": "keep_add_new", "target_fact_id": None}
-        if text.startswith("```"):
-            text = text.split("```")[1]
-            if text.startswith("json"):
-                text = text[4:]
-            text = text.strip()
         try:
-            data = json.loads(text)
+            data = _loads_model_json(text)
             if not isinstance(data, dict):
                 return {"action": "keep_add_new", "target_fact_id": None}
             action = str(data.get("action", "keep_add_new")).strip().lower()
@@ -299,20 +360,53 @@ class GeminiClient:
         return response.embeddings[0].values
 
 
-def _parse_bot_response(raw: str) -> tuple[str, bool]:
-    """Parse the JSON response from the bot.
+def _format_history_turn(entry: dict) -> str:
+    author = entry.get("author") or ("bot" if entry["role"] == "model" else "user")
+    return f"[{author}]: {entry['text']}"
 
-    Falls back gracefully if the model didn't honour the JSON format.
-    """
-    text = raw.strip()
+
+def _normalize_facts(items: list) -> list[dict]:
+    """Validate raw fact objects from the model into the stored fact shape."""
+    valid_facts: list[dict] = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        fact_text = str(item.get("fact", "")).strip()
+        if not fact_text:
+            continue
+        scope = item.get("scope", "user")
+        if scope not in {"user", "chat"}:
+            scope = "user"
+        valid_facts.append(
+            {
+                "fact": fact_text,
+                "importance": float(item.get("importance", 0.5)),
+                "confidence": float(item.get("confidence", 0.8)),
+                "scope": scope,
+            }
+        )
+    return valid_facts
+
+
+def _loads_model_json(text: str):
+    """Decode JSON emitted by the model, tolerating markdown code fences."""
+    text = text.strip()
     # Strip markdown code fences if the model added them anyway.
     if text.startswith("```"):
         text = text.split("```")[1]
         if text.startswith("json"):
             text = text[4:]
         text = text.strip()
+    return _json_loads(text)
+
+
+def _parse_bot_response(raw: str) -> tuple[str, bool]:
+    """Parse the JSON response from the bot.
+
+    Falls back gracefully if the model didn't honour the JSON format.
+    """
     try:
-        data = json.loads(text)
+        data = _loads_model_json(raw)
         answer = str(data.get("answer", raw))
         save_profile = bool(data.get("save_to_profile", False))
         return answer, save_profile
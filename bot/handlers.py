@@ -1,7 +1,9 @@
 import os
 import asyncio
 import logging
-from telegram import Update
+from datetime import timedelta
+from telegram import Message, Update
+from telegram.error import NetworkError, RetryAfter, TimedOut
 from telegram.ext import ContextTypes
 from .session import SessionManager
 from .gemini import GeminiClient
@@ -17,6 +19,14 @@ ALLOWED_CHAT_IDS: set[int] = {
 
 MEMORY_UPDATE_INTERVAL = int(os.getenv("MEMORY_UPDATE_INTERVAL", "10"))
 
+# Interval-triggered fact refreshes are held this long so that users of the
+# same chat who cross the interval together share one extraction call.
+PROFILE_UPDATE_BATCH_DELAY = float(os.getenv("PROFILE_UPDATE_BATCH_DELAY", "5"))
+
+# Replies hit by flood control (429) or a dropped connection are re-sent.
+REPLY_MAX_ATTEMPTS = 3
+REPLY_RETRY_BASE_DELAY = 1.0
+
 session_manager = SessionManager(
     max_messages=int(os.getenv("MAX_HISTORY_MESSAGES", "100"))
 )
@@ -77,6 +87,16 @@ class _LazyGeminiClient:
             user_name=user_name,
         )
 
+    def extract_facts_batch(
+        self,
+        users: list[tuple[int, str, list[str]]],
+        recent_history: str,
+    ) -> dict[int, list[dict]]:
+        return self._get().extract_facts_batch(
+            users=users,
+            recent_history=recent_history,
+        )
+
     def decide_fact_action(
         self,
         candidate_fact: str,
@@ -93,6 +113,60 @@ class _LazyGeminiClient:
 
 gemini_client: _LazyGeminiClient = _LazyGeminiClient()
 
+# Users waiting for an interval-triggered fact refresh: chat_id → {user_id: name}
+_pending_profile_updates: dict[int, dict[int, str]] = {}
+_profile_flush_tasks: dict[int, asyncio.Task] = {}  # still waiting out the delay
+_active_profile_flushes: set[asyncio.Task] = set()  # every flush until it finishes
+
+
+def _log_background_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Unhandled error in background profile update: %s", task.exception())
+
+
+def _schedule_profile_update(user_id: int, chat_id: int, user_name: str) -> None:
+    """Queue a background fact refresh, coalescing users of the same chat."""
+    _pending_profile_updates.setdefault(chat_id, {})[user_id] = user_name
+    if chat_id in _profile_flush_tasks:
+        return
+    task = asyncio.create_task(_flush_profile_updates(chat_id))
+    _profile_flush_tasks[chat_id] = task
+    _active_profile_flushes.add(task)
+    task.add_done_callback(_active_profile_flushes.discard)
+    task.add_done_callback(_log_background_error)
+
+
+async def _flush_profile_updates(chat_id: int) -> None:
+    try:
+        await asyncio.sleep(PROFILE_UPDATE_BATCH_DELAY)
+    finally:
+        _profile_flush_tasks.pop(chat_id, None)
+    await _run_profile_updates(chat_id)
+
+
+async def flush_pending_profile_updates(*_args) -> None:
+    """Run every queued profile refresh now instead of after the batch delay.
+
+    Registered as the application's ``post_shutdown`` hook so updates queued
+    just before the bot stops are not lost. Flushes still sleeping are
+    cancelled and run here; flushes already talking to Gemini are awaited.
+    """
+    for task in list(_profile_flush_tasks.values()):
+        task.cancel()
+    _profile_flush_tasks.clear()
+    await asyncio.gather(*_active_profile_flushes, return_exceptions=True)
+    for chat_id in list(_pending_profile_updates):
+        await _run_profile_updates(chat_id)
+
+
+async def _run_profile_updates(chat_id: int) -> None:
+    pending = _pending_profile_updates.pop(chat_id, {})
+    if len(pending) == 1:
+        [(user_id, user_name)] = pending.items()
+        await _update_user_profile(user_id, chat_id, user_name)
+    elif pending:
+        await _update_user_profiles_batch(chat_id, pending)
+
 
 async def _update_user_profile(
     user_id: int, chat_id: int, user_name: str
@@ -100,64 +174,103 @@ async def _update_user_profile(
     try:
         existing_facts = user_memory.get_user_facts(user_id=user_id, limit=40)
         recent_history = session_manager.format_history(chat_id)
-        extracted_facts = gemini_client.extract_facts(
+        extracted_facts = await asyncio.to_thread(
+            gemini_client.extract_facts,
             existing_facts=existing_facts,
             recent_history=recent_history,
             user_name=f"{user_name} [ID: {user_id}]",
         )
         if not extracted_facts:
             return
+        await _store_extracted_facts(user_id, chat_id, user_name, extracted_facts)
+    except Exception:
+        logger.exception("Failed to update profile for user %s", user_id)
 
-        user_facts = []
-        chat_facts = []
-        for item in extracted_facts:
-            fact_text = str(item.get("fact", "")).strip()
-            if not fact_text:
-                continue
-            scoped_fact = dict(item)
-            scoped_fact["embedding"] = gemini_client.embed_text(fact_text)
-            if item.get("scope") == "chat":
-                similar_facts = user_memory.find_similar_facts(
-                    scope="chat",
-                    query_embedding=scoped_fact["embedding"],
-                    chat_id=chat_id,
-                    limit=3,
-                )
-                if similar_facts:
-                    scoped_fact.update(
-                        gemini_client.decide_fact_action(
-                            candidate_fact=fact_text,
-                            scope="chat",
-                            similar_facts=similar_facts,
-                            user_name=user_name,
-                        )
+
+async def _update_user_profiles_batch(chat_id: int, users: dict[int, str]) -> None:
+    """Refresh facts for several users of one chat with a single extraction call."""
+    try:
+        recent_history = session_manager.format_history(chat_id)
+        existing_facts = user_memory.get_user_facts_bulk(list(users), limit=40)
+        extracted = await asyncio.to_thread(
+            gemini_client.extract_facts_batch,
+            users=[
+                (user_id, user_name, existing_facts[user_id])
+                for user_id, user_name in users.items()
+            ],
+            recent_history=recent_history,
+        )
+    except Exception:
+        logger.exception("Failed to extract facts for chat %s", chat_id)
+        return
+
+    for user_id, user_name in users.items():
+        extracted_facts = extracted.get(user_id)
+        if not extracted_facts:
+            continue
+        try:
+            await _store_extracted_facts(user_id, chat_id, user_name, extracted_facts)
+        except Exception:
+            logger.exception("Failed to update profile for user %s", user_id)
+
+
+async def _store_extracted_facts(
+    user_id: int, chat_id: int, user_name: str, extracted_facts: list[dict]
+) -> None:
+    # Gemini calls run in worker threads. SQLite stays on the event loop:
+    # UserMemory's single connection and caches are not guarded for threads.
+    user_facts = []
+    chat_facts = []
+    for item in extracted_facts:
+        fact_text = str(item.get("fact", "")).strip()
+        if not fact_text:
+            continue
+        scoped_fact = dict(item)
+        scoped_fact["embedding"] = await asyncio.to_thread(
+            gemini_client.embed_text, fact_text
+        )
+        if item.get("scope") == "chat":
+            similar_facts = user_memory.find_similar_facts(
+                scope="chat",
+                query_embedding=scoped_fact["embedding"],
+                chat_id=chat_id,
+                limit=3,
+            )
+            if similar_facts:
+                scoped_fact.update(
+                    await asyncio.to_thread(
+                        gemini_client.decide_fact_action,
+                        candidate_fact=fact_text,
+                        scope="chat",
+                        similar_facts=similar_facts,
+                        user_name=user_name,
                     )
-                chat_facts.append(scoped_fact)
-            else:
-                similar_facts = user_memory.find_similar_facts(
-                    scope="user",
-                    query_embedding=scoped_fact["embedding"],
-                    user_id=user_id,
-                    limit=3,
                 )
-                if similar_facts:
-                    scoped_fact.update(
-                        gemini_client.decide_fact_action(
-                            candidate_fact=fact_text,
-                            scope="user",
-                            similar_facts=similar_facts,
-                            user_name=user_name,
-                        )
+            chat_facts.append(scoped_fact)
+        else:
+            similar_facts = user_memory.find_similar_facts(
+                scope="user",
+                query_embedding=scoped_fact["embedding"],
+                user_id=user_id,
+                limit=3,
+            )
+            if similar_facts:
+                scoped_fact.update(
+                    await asyncio.to_thread(
+                        gemini_client.decide_fact_action,
+                        candidate_fact=fact_text,
+                        scope="user",
+                        similar_facts=similar_facts,
+                        user_name=user_name,
                     )
-                user_facts.append(scoped_fact)
+                )
+            user_facts.append(scoped_fact)
 
-        if user_facts:
-            user_memory.upsert_user_facts(user_id=user_id, chat_id=chat_id, facts=user_facts)
-        if chat_facts:
-            user_memory.upsert_chat_facts(chat_id=chat_id, facts=chat_facts)
-        logger.info("Updated fact memory for user %s (%s)", user_id, user_name)
-    except Exception:
-        logger.exception("Failed to update profile for user %s", user_id)
+    if user_facts:
+        user_memory.upsert_user_facts(user_id=user_id, chat_id=chat_id, facts=user_facts)
+    if chat_facts:
+        user_memory.upsert_chat_facts(chat_id=chat_id, facts=chat_facts)
+    logger.info("Updated fact memory for user %s (%s)", user_id, user_name)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -182,12 +295,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         first_name=author,
     )
     if msg_count % MEMORY_UPDATE_INTERVAL == 0:
-        task = asyncio.create_task(_update_user_profile(user.id, chat_id, author))
-        task.add_done_callback(
-            lambda t: logger.error("Unhandled error in background profile update: %s", t.exception())
-            if not t.cancelled() and t.exception() is not None
-            else None
-        )
+        _schedule_profile_update(user.id, chat_id, author)
     is_private = update.message.chat.type == "private"
     bot_username = context.bot.username
     is_reply_to_bot = (
@@ -248,16 +356,39 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await _update_user_profile(user.id, chat_id, author)
 
         if len(response) <= 4096:
-            await update.message.reply_text(response)
+            await _reply_text(update.message, response)
         else:
             for i in range(0, len(response), 4096):
-                await update.message.reply_text(response[i : i + 4096])
+                await _reply_text(update.message, response[i : i + 4096])
     except Exception:
         typing_task.cancel()
         logger.exception("Gemini API call failed")
-        await update.message.reply_text(
-            "Sorry, something went wrong. Try again."
-        )
+        await _reply_text(update.message, "Sorry, something went wrong. Try again.")
+
+
+async def _reply_text(message: Message, text: str) -> None:
+    """``reply_text`` that waits out flood control and retries network errors.
+
+    ``TimedOut`` is not retried: the message may already have been delivered.
+    """
+    for attempt in range(REPLY_MAX_ATTEMPTS):
+        try:
+            await message.reply_text(text)
+            return
+        except RetryAfter as exc:
+            if attempt == REPLY_MAX_ATTEMPTS - 1:
+                raise
+            delay = exc.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+        except TimedOut:
+            raise
+        except NetworkError:
+            if attempt == REPLY_MAX_ATTEMPTS - 1:
+                raise
+            delay = min(REPLY_RETRY_BASE_DELAY * 2**attempt, 30.0)
+        logger.warning("Reply failed (attempt %s), retrying in %ss", attempt + 1, delay)
+        await asyncio.sleep(delay)
 
 
 def _format_fact_for_prompt(fact: dict) -> str:
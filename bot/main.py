@@ -8,7 +8,7 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from .handlers import handle_message
+from .handlers import flush_pending_profile_updates, handle_message
 from .memory_handlers import (
     handle_memory_callback,
     handle_memory_command,
@@ -39,7 +39,12 @@ def main() -> None:
     if not os.getenv("GEMINI_API_KEY"):
         raise ValueError("GEMINI_API_KEY environment variable is not set")
 
-    app = Application.builder().token(token).build()
+    app = (
+        Application.builder()
+        .token(token)
+        .post_shutdown(flush_pending_profile_updates)
+        .build()
+    )
     app.add_handler(CommandHandler("memory", handle_memory_command))
     app.add_handler(CallbackQueryHandler(handle_memory_callback, pattern=r"^mem:"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, _message_dispatcher))
@@ -2,9 +2,11 @@ import json
 import logging
 import math
 import sqlite3
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 
@@ -17,15 +19,95 @@ class UserMemory:
     def __init__(self, db_path: str = "/app/data/memory.db"):
         self.db_path = db_path
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        # One connection for the instance's lifetime instead of one per call.
+        # `with self._conn:` commits on success and rolls back on error.
+        # It and the caches below are unlocked: use the instance from the
+        # thread that created it (the event loop), never via asyncio.to_thread.
+        self._conn = sqlite3.connect(db_path)
         # Alembic now handles schema creation; we just ensure WAL mode is on for performance
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Corruption-safe under WAL; a power loss can only drop the last commits
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Normalised embedding matrices keyed by (table, dimension). They are
+        # dropped whenever this instance writes (`_writes`) or another
+        # connection commits (`PRAGMA data_version`), e.g. Datasette edits.
+        self._writes = 0
+        self._index_version: tuple[int, int] | None = None
+        self._index_cache: dict[tuple[str, int], tuple[np.ndarray, np.ndarray]] = {}
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _embedding_index(self, table: str, dim: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return sorted row ids and L2-normalised float32 embeddings of size ``dim``."""
+        version = (self._conn.execute("PRAGMA data_version").fetchone()[0], self._writes)
+        if version != self._index_version:
+            self._index_cache.clear()
+            self._index_version = version
+        key = (table, dim)
+        if key not in self._index_cache:
+            self._index_cache[key] = self._build_embedding_index(table, dim)
+        return self._index_cache[key]
+
+    def _build_embedding_index(self, table: str, dim: int) -> tuple[np.ndarray, np.ndarray]:
+        if table == "memory_facts":
+            query = (
+                "SELECT id, embedding FROM memory_facts "
+                "WHERE is_active = 1 AND embedding IS NOT NULL ORDER BY id"
+            )
+        else:
+            query = (
+                "SELECT user_id, profile_embedding FROM user_profiles "
+                "WHERE profile_embedding IS NOT NULL ORDER BY user_id"
+            )
+        with self._conn as conn:
+            rows = conn.execute(query).fetchall()
+
+        ids = []
+        embeddings = []
+        for row_id, emb_value in rows:
+            try:
+                emb = _decode_embedding(emb_value)
+            except (TypeError, ValueError):
+                continue
+            if emb.size == dim:
+                ids.append(row_id)
+                embeddings.append(emb)
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty((0, dim), dtype=np.float32)
+
+        matrix = np.vstack(embeddings)
+        norms = np.linalg.norm(matrix, axis=1)
+        keep = norms > 0
+        matrix = matrix[keep] / norms[keep, None]
+        return np.asarray(ids, dtype=np.int64)[keep], matrix
+
+    def _indexed_similarities(self, table: str, row_ids: list[int], query: list[float]) -> np.ndarray:
+        """Cosine similarity of ``query`` against the cached embeddings of ``row_ids``.
+
+        Ids without a usable embedding of the query's dimension come back as NaN.
+        """
+        similarities = np.full(len(row_ids), np.nan, dtype=np.float32)
+        q = np.asarray(query, dtype=np.float32)
+        if q.ndim != 1 or not q.size or not row_ids:
+            return similarities
+        q_norm = np.linalg.norm(q)
+        if q_norm == 0:
+            return similarities
+        index_ids, matrix = self._embedding_index(table, q.size)
+        if not index_ids.size:
+            return similarities
+        wanted = np.asarray(row_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(index_ids, wanted), index_ids.size - 1)
+        found = index_ids[positions] == wanted
+        similarities[found] = matrix[positions[found]] @ (q / q_norm)
+        return similarities
 
     def increment_message_count(
         self, user_id: int, chat_id: int, username: str, first_name: str
     ) -> int:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
+        with self._conn as conn:
+            row = conn.execute(
                 """
                 INSERT INTO user_profiles (user_id, username, first_name, msg_count)
                 VALUES (?, ?, ?, 1)
@@ -33,22 +115,19 @@ class UserMemory:
                     msg_count  = msg_count + 1,
                     username   = excluded.username,
                     first_name = excluded.first_name
+                RETURNING msg_count
                 """,
                 (user_id, username, first_name),
-            )
+            ).fetchone()
             conn.execute(
                 "INSERT OR IGNORE INTO chat_memberships (user_id, chat_id) VALUES (?, ?)",
                 (user_id, chat_id),
             )
             conn.commit()
-            row = conn.execute(
-                "SELECT msg_count FROM user_profiles WHERE user_id = ?",
-                (user_id,),
-            ).fetchone()
             return row[0]
 
     def get_profile(self, user_id: int) -> str:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             row = conn.execute(
                 "SELECT profile FROM user_profiles WHERE user_id = ?",
                 (user_id,),
@@ -56,17 +135,18 @@ class UserMemory:
             return row[0] if row and row[0] else ""
 
     def update_profile(self, user_id: int, profile: str, embedding: list[float] | None = None) -> None:
-        emb_json = json.dumps(embedding) if embedding else None
-        with sqlite3.connect(self.db_path) as conn:
+        emb_blob = _encode_embedding(embedding)
+        with self._conn as conn:
             cursor = conn.execute(
                 """
                 UPDATE user_profiles
                 SET profile = ?, profile_embedding = ?, updated_at = ?
                 WHERE user_id = ?
                 """,
-                (profile, emb_json, datetime.now(timezone.utc).isoformat(), user_id),
+                (profile, emb_blob, datetime.now(timezone.utc).isoformat(), user_id),
             )
             conn.commit()
+            self._writes += 1
             if cursor.rowcount == 0:
                 logger.warning("update_profile: no row found for user_id=%s", user_id)
 
@@ -79,34 +159,20 @@ class UserMemory:
         if not query_embedding:
             return []
             
-        profiles_with_embeddings = []
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             rows = conn.execute(
-                "SELECT user_id, first_name, profile, profile_embedding FROM user_profiles "
+                "SELECT user_id, first_name, profile FROM user_profiles "
                 "WHERE profile_embedding IS NOT NULL AND profile != ''"
             ).fetchall()
-            
-            for row in rows:
-                try:
-                    uid, name, text, emb_str = row
-                    emb = json.loads(emb_str)
-                    profiles_with_embeddings.append((uid, name, text, emb))
-                except (json.JSONDecodeError, ValueError) as e:
-                    logger.warning("Failed to decode embedding for %s: %s", row[1], e)
-                    
-        # Calculate cosine similarity
-        results = []
 
-        for uid, name, text, emb in profiles_with_embeddings:
-            similarity = _cosine_similarity(emb, query_embedding)
-            if similarity is not None:
-                results.append((similarity, uid, name, text))
-                
-        # Sort by similarity descending
-        results.sort(key=lambda x: x[0], reverse=True)
-        
+        # Calculate cosine similarity against all profiles at once
+        similarities = self._indexed_similarities(
+            "user_profiles", [row[0] for row in rows], query_embedding
+        )
+        matched = np.flatnonzero(~np.isnan(similarities))
+
         # Return only the matched names and text (without similarity score)
-        return [(uid, name, text) for _, uid, name, text in results[:limit]]
+        return [rows[i] for i in matched[_top_k(similarities[matched], limit)]]
 
     def upsert_user_facts(self, user_id: int, chat_id: int, facts: list[dict]) -> None:
         self._upsert_facts(scope="user", user_id=user_id, chat_id=chat_id, facts=facts)
@@ -130,11 +196,11 @@ class UserMemory:
         if scope == "chat" and chat_id is None:
             return []
 
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             if scope == "user":
                 rows = conn.execute(
                     """
-                    SELECT id, fact_text, embedding
+                    SELECT id, fact_text
                     FROM memory_facts
                     WHERE is_active = 1
                       AND embedding IS NOT NULL
@@ -146,7 +212,7 @@ class UserMemory:
             else:
                 rows = conn.execute(
                     """
-                    SELECT id, fact_text, embedding
+                    SELECT id, fact_text
                     FROM memory_facts
                     WHERE is_active = 1
                       AND embedding IS NOT NULL
@@ -156,25 +222,20 @@ class UserMemory:
                     (chat_id,),
                 ).fetchall()
 
-        results = []
-        for row in rows:
-            try:
-                fact_id, fact_text, emb_str = row
-                fact_embedding = json.loads(emb_str)
-            except (json.JSONDecodeError, TypeError, ValueError):
-                continue
-            similarity = _cosine_similarity(fact_embedding, query_embedding)
-            if similarity is None or similarity < min_semantic:
-                continue
-            results.append(
-                {
-                    "fact_id": fact_id,
-                    "fact_text": fact_text,
-                    "similarity": similarity,
-                }
-            )
-        results.sort(key=lambda item: item["similarity"], reverse=True)
-        return results[:limit]
+        similarities = self._indexed_similarities(
+            "memory_facts", [row[0] for row in rows], query_embedding
+        )
+
+        # NaN compares False, so unscorable rows drop out here too
+        matched = np.flatnonzero(similarities >= min_semantic)
+        return [
+            {
+                "fact_id": rows[i][0],
+                "fact_text": rows[i][1],
+                "similarity": float(similarities[i]),
+            }
+            for i in matched[_top_k(similarities[matched], limit)]
+        ]
 
     def _upsert_facts(
         self,
@@ -187,7 +248,25 @@ class UserMemory:
             return
 
         now = _now_iso()
-        with sqlite3.connect(self.db_path) as conn:
+        pending_inserts: dict[str, list] = {}
+        with self._conn as conn:
+            # One lookup of the owner's facts instead of a SELECT per item.
+            owned = conn.execute(
+                """
+                SELECT id, fact_text
+                FROM memory_facts
+                WHERE scope = ?
+                  AND COALESCE(user_id, -1) = COALESCE(?, -1)
+                  AND COALESCE(chat_id, -1) = COALESCE(?, -1)
+                ORDER BY id
+                """,
+                (scope, user_id, chat_id),
+            ).fetchall()
+            text_by_id = dict(owned)
+            id_by_text: dict[str, int] = {}
+            for fact_id, text in owned:
+                id_by_text.setdefault(text, fact_id)
+
             for item in facts:
                 fact_text = str(item.get("fact") or item.get("fact_text") or "").strip()
                 if not fact_text:
@@ -195,7 +274,7 @@ class UserMemory:
                 importance = _clamp01(item.get("importance", 0.5))
                 confidence = _clamp01(item.get("confidence", 0.8))
                 embedding = item.get("embedding")
-                emb_json = json.dumps(embedding) if embedding else None
+                emb_blob = _encode_embedding(embedding)
                 action = str(item.get("action", "keep_add_new")).strip().lower()
                 target_fact_id = item.get("target_fact_id")
                 try:
@@ -206,102 +285,95 @@ class UserMemory:
                 if action == "noop":
                     continue
 
-                if action in {"update_existing", "deactivate_existing"} and target_fact_id is not None:
-                    target_exists = conn.execute(
-                        """
-                        SELECT id
-                        FROM memory_facts
-                        WHERE id = ?
-                          AND scope = ?
-                          AND COALESCE(user_id, -1) = COALESCE(?, -1)
-                          AND COALESCE(chat_id, -1) = COALESCE(?, -1)
-                        """,
-                        (target_fact_id, scope, user_id, chat_id),
-                    ).fetchone()
-                    if target_exists:
-                        if action == "deactivate_existing":
-                            conn.execute(
-                                """
-                                UPDATE memory_facts
-                                SET is_active = 0,
-                                    updated_at = ?
-                                WHERE id = ?
-                                """,
-                                (now, target_fact_id),
-                            )
-                            continue
+                if action in {"update_existing", "deactivate_existing"} and target_fact_id in text_by_id:
+                    if action == "deactivate_existing":
                         conn.execute(
                             """
                             UPDATE memory_facts
-                            SET fact_text = ?,
-                                embedding = COALESCE(?, embedding),
-                                importance = ?,
-                                confidence = ?,
-                                is_active = 1,
+                            SET is_active = 0,
                                 updated_at = ?
                             WHERE id = ?
                             """,
-                            (
-                                fact_text,
-                                emb_json,
-                                importance,
-                                confidence,
-                                now,
-                                target_fact_id,
-                            ),
+                            (now, target_fact_id),
                         )
                         continue
-
-                existing = conn.execute(
-                    """
-                    SELECT id
-                    FROM memory_facts
-                    WHERE scope = ?
-                      AND COALESCE(user_id, -1) = COALESCE(?, -1)
-                      AND COALESCE(chat_id, -1) = COALESCE(?, -1)
-                      AND fact_text = ?
-                    """,
-                    (scope, user_id, chat_id, fact_text),
-                ).fetchone()
-                if existing:
                     conn.execute(
                         """
                         UPDATE memory_facts
-                        SET embedding = COALESCE(?, embedding),
+                        SET fact_text = ?,
+                            embedding = COALESCE(?, embedding),
                             importance = ?,
                             confidence = ?,
                             is_active = 1,
                             updated_at = ?
                         WHERE id = ?
                         """,
-                        (emb_json, importance, confidence, now, existing[0]),
-                    )
-                else:
-                    conn.execute(
-                        """
-                        INSERT INTO memory_facts (
-                            scope, user_id, chat_id, fact_text, embedding,
-                            importance, confidence, is_active, use_count,
-                            last_used_at, created_at, updated_at
-                        )
-                        VALUES (?, ?, ?, ?, ?, ?, ?, 1, 0, NULL, ?, ?)
-                        """,
                         (
-                            scope,
-                            user_id,
-                            chat_id,
                             fact_text,
-                            emb_json,
+                            emb_blob,
                             importance,
                             confidence,
                             now,
-                            now,
+                            target_fact_id,
                         ),
                     )
+                    old_text = text_by_id[target_fact_id]
+                    if id_by_text.get(old_text) == target_fact_id:
+                        del id_by_text[old_text]
+                    text_by_id[target_fact_id] = fact_text
+                    id_by_text.setdefault(fact_text, target_fact_id)
+                    continue
+
+                existing_id = id_by_text.get(fact_text)
+                if existing_id is not None:
+                    conn.execute(
+                        """
+                        UPDATE memory_facts
+                        SET embedding = COALESCE(?, embedding),
+                            importance = ?,
+                            confidence = ?,
+                            is_active = 1,
+                            updated_at = ?
+                        WHERE id = ?
+                        """,
+                        (emb_blob, importance, confidence, now, existing_id),
+                    )
+                elif fact_text in pending_inserts:
+                    # Repeated text within the batch refreshes the queued row
+                    row = pending_inserts[fact_text]
+                    row[4] = emb_blob if emb_blob is not None else row[4]
+                    row[5] = importance
+                    row[6] = confidence
+                else:
+                    pending_inserts[fact_text] = [
+                        scope,
+                        user_id,
+                        chat_id,
+                        fact_text,
+                        emb_blob,
+                        importance,
+                        confidence,
+                        now,
+                        now,
+                    ]
+
+            if pending_inserts:
+                conn.executemany(
+                    """
+                    INSERT INTO memory_facts (
+                        scope, user_id, chat_id, fact_text, embedding,
+                        importance, confidence, is_active, use_count,
+                        last_used_at, created_at, updated_at
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 1, 0, NULL, ?, ?)
+                    """,
+                    list(pending_inserts.values()),
+                )
             conn.commit()
+            self._writes += 1
 
     def get_user_facts(self, user_id: int, limit: int = 30) -> list[str]:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             rows = conn.execute(
                 """
                 SELECT fact_text
@@ -309,15 +381,46 @@ class UserMemory:
                 WHERE scope = 'user'
                   AND user_id = ?
                   AND is_active = 1
-                ORDER BY updated_at DESC
+                ORDER BY updated_at DESC, id DESC
                 LIMIT ?
                 """,
                 (user_id, limit),
             ).fetchall()
         return [row[0] for row in rows]
 
+    def get_user_facts_bulk(self, user_ids: list[int], limit: int = 30) -> dict[int, list[str]]:
+        """``get_user_facts`` for several users in one query, keyed by user_id."""
+        facts: dict[int, list[str]] = {user_id: [] for user_id in user_ids}
+        if not facts:
+            return facts
+        placeholders = ",".join("?" for _ in facts)
+        with self._conn as conn:
+            rows = conn.execute(
+                f"""
+                SELECT user_id, fact_text
+                FROM (
+                    SELECT
+                        user_id,
+                        fact_text,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY user_id ORDER BY updated_at DESC, id DESC
+                        ) AS rank
+                    FROM memory_facts
+                    WHERE scope = 'user'
+                      AND user_id IN ({placeholders})
+                      AND is_active = 1
+                )
+                WHERE rank <= ?
+                ORDER BY user_id, rank
+                """,
+                (*facts, limit),
+            ).fetchall()
+        for user_id, fact_text in rows:
+            facts[user_id].append(fact_text)
+        return facts
+
     def get_chat_facts(self, chat_id: int, limit: int = 30) -> list[str]:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             rows = conn.execute(
                 """
                 SELECT fact_text
@@ -325,7 +428,7 @@ class UserMemory:
                 WHERE scope = 'chat'
                   AND chat_id = ?
                   AND is_active = 1
-                ORDER BY updated_at DESC
+                ORDER BY updated_at DESC, id DESC
                 LIMIT ?
                 """,
                 (chat_id, limit),
@@ -342,7 +445,7 @@ class UserMemory:
             ``{"id": int, "fact_text": str}``.
         """
         offset = page * page_size
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             total = conn.execute(
                 """
                 SELECT COUNT(*)
@@ -360,7 +463,7 @@ class UserMemory:
                 WHERE scope = 'user'
                   AND user_id = ?
                   AND is_active = 1
-                ORDER BY updated_at DESC
+                ORDER BY updated_at DESC, id DESC
                 LIMIT ? OFFSET ?
                 """,
                 (user_id, page_size, offset),
@@ -368,9 +471,25 @@ class UserMemory:
         facts = [{"id": row[0], "fact_text": row[1]} for row in rows]
         return facts, total
 
+    def get_fact_by_id(self, fact_id: int, user_id: int) -> dict | None:
+        """Return one active user-scope fact as ``{"id", "fact_text"}``, or None."""
+        with self._conn as conn:
+            row = conn.execute(
+                """
+                SELECT id, fact_text
+                FROM memory_facts
+                WHERE id = ?
+                  AND user_id = ?
+                  AND scope = 'user'
+                  AND is_active = 1
+                """,
+                (fact_id, user_id),
+            ).fetchone()
+        return {"id": row[0], "fact_text": row[1]} if row else None
+
     def delete_fact(self, fact_id: int, user_id: int) -> bool:
         """Delete a user-scope fact by ID. Returns True if a row was deleted."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             cursor = conn.execute(
                 """
                 DELETE FROM memory_facts
@@ -381,11 +500,12 @@ class UserMemory:
                 (fact_id, user_id),
             )
             conn.commit()
+            self._writes += 1
             return cursor.rowcount > 0
 
     def update_fact_text(self, fact_id: int, user_id: int, new_text: str) -> bool:
         """Update fact text and clear its embedding. Returns True if updated."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             cursor = conn.execute(
                 """
                 UPDATE memory_facts
@@ -399,6 +519,7 @@ class UserMemory:
                 (new_text, _now_iso(), fact_id, user_id),
             )
             conn.commit()
+            self._writes += 1
             return cursor.rowcount > 0
 
     def search_facts_by_embedding(
@@ -414,8 +535,11 @@ class UserMemory:
             return []
 
         now_dt = datetime.now(timezone.utc)
+        # julianday() normalises naive, "Z" and offset timestamps (e.g. written
+        # through Datasette) before comparing; unparseable values count as fresh.
+        cooldown_cutoff = (now_dt - timedelta(seconds=cooldown_seconds)).isoformat()
         results = []
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             rows = conn.execute(
                 """
                 SELECT
@@ -424,15 +548,17 @@ class UserMemory:
                     f.user_id,
                     f.chat_id,
                     f.fact_text,
-                    f.embedding,
                     f.importance,
-                    f.last_used_at,
                     f.updated_at,
                     p.first_name
                 FROM memory_facts f
                 LEFT JOIN user_profiles p ON p.user_id = f.user_id
                 WHERE f.is_active = 1
                   AND f.embedding IS NOT NULL
+                  AND (
+                      COALESCE(f.last_used_at, '') = ''
+                      OR julianday(f.last_used_at) <= julianday(?)
+                  )
                   AND (
                       (f.scope = 'chat' AND f.chat_id = ?)
                       OR (f.scope = 'user' AND f.user_id = ?)
@@ -444,69 +570,61 @@ class UserMemory:
                       )
                   )
                 """,
-                (chat_id, asking_user_id, chat_id),
+                (cooldown_cutoff, chat_id, asking_user_id, chat_id),
             ).fetchall()
 
-            for row in rows:
-                try:
-                    (
-                        fact_id,
-                        scope,
-                        fact_user_id,
-                        fact_chat_id,
-                        fact_text,
-                        emb_str,
-                        importance,
-                        last_used_at,
-                        updated_at,
-                        owner_name,
-                    ) = row
-                    embedding = json.loads(emb_str)
-                except (json.JSONDecodeError, TypeError, ValueError):
-                    continue
-
-                semantic = _cosine_similarity(embedding, query_embedding)
-                if semantic is None or semantic < min_semantic:
-                    continue
-
-                if last_used_at:
-                    last_used_dt = _parse_ts(last_used_at)
-                    if (now_dt - last_used_dt).total_seconds() < cooldown_seconds:
-                        continue
+        similarities = self._indexed_similarities(
+            "memory_facts", [row[0] for row in rows], query_embedding
+        )
+
+        for row, semantic in zip(rows, similarities):
+            (
+                fact_id,
+                scope,
+                fact_user_id,
+                fact_chat_id,
+                fact_text,
+                importance,
+                updated_at,
+                owner_name,
+            ) = row
+            if np.isnan(semantic) or semantic < min_semantic:
+                continue
+            semantic = float(semantic)
 
-                updated_dt = _parse_ts(updated_at)
-                age_days = max((now_dt - updated_dt).total_seconds() / 86400.0, 0.0)
-                recency = math.exp(-age_days / self.FACT_RECENCY_DECAY_DAYS)
-                importance_score = _clamp01(importance)
+            updated_dt = _parse_ts(updated_at)
+            age_days = max((now_dt - updated_dt).total_seconds() / 86400.0, 0.0)
+            recency = math.exp(-age_days / self.FACT_RECENCY_DECAY_DAYS)
+            importance_score = _clamp01(importance)
 
-                score = (
-                    self.FACT_WEIGHT_SEMANTIC * semantic
-                    + self.FACT_WEIGHT_RECENCY * recency
-                    + self.FACT_WEIGHT_IMPORTANCE * importance_score
-                )
-                results.append(
-                    {
-                        "fact_id": fact_id,
-                        "scope": scope,
-                        "user_id": fact_user_id,
-                        "chat_id": fact_chat_id,
-                        "owner_name": owner_name or "Unknown",
-                        "fact_text": fact_text,
-                        "semantic_score": semantic,
-                        "recency_score": recency,
-                        "importance_score": importance_score,
-                        "score": score,
-                    }
-                )
+            score = (
+                self.FACT_WEIGHT_SEMANTIC * semantic
+                + self.FACT_WEIGHT_RECENCY * recency
+                + self.FACT_WEIGHT_IMPORTANCE * importance_score
+            )
+            results.append(
+                {
+                    "fact_id": fact_id,
+                    "scope": scope,
+                    "user_id": fact_user_id,
+                    "chat_id": fact_chat_id,
+                    "owner_name": owner_name or "Unknown",
+                    "fact_text": fact_text,
+                    "semantic_score": semantic,
+                    "recency_score": recency,
+                    "importance_score": importance_score,
+                    "score": score,
+                }
+            )
 
-        results.sort(key=lambda item: item["score"], reverse=True)
-        return results[:limit]
+        scores = np.fromiter((item["score"] for item in results), dtype=np.float64, count=len(results))
+        return [results[i] for i in _top_k(scores, limit)]
 
     def mark_facts_used(self, fact_ids: list[int]) -> None:
         if not fact_ids:
             return
         placeholders = ",".join("?" for _ in fact_ids)
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             conn.execute(
                 f"""
                 UPDATE memory_facts
@@ -520,7 +638,7 @@ class UserMemory:
 
     def get_chat_members(self, chat_id: int) -> list[tuple[int, str]]:
         """Return a list of (user_id, first_name) for members in this chat."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             rows = conn.execute(
                 """
                 SELECT p.user_id, p.first_name
@@ -558,13 +676,27 @@ def _clamp01(value: float | int | None) -> float:
     return max(0.0, min(1.0, parsed))
 
 
-def _cosine_similarity(vec_a: list[float], vec_b: list[float]) -> float | None:
-    if len(vec_a) != len(vec_b):
-        return None
-    mag_a = math.sqrt(sum(v * v for v in vec_a))
-    mag_b = math.sqrt(sum(v * v for v in vec_b))
-    if mag_a == 0 or mag_b == 0:
+def _encode_embedding(embedding: list[float] | None) -> bytes | None:
+    """Pack an embedding as raw float32 bytes for the ``embedding`` columns."""
+    if embedding is None or len(embedding) == 0:
         return None
-    dot_product = sum(a * b for a, b in zip(vec_a, vec_b))
-    return dot_product / (mag_a * mag_b)
-
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def _decode_embedding(value: bytes | str) -> np.ndarray:
+    """Unpack a stored embedding; rows written before BLOB storage hold JSON text."""
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype=np.float32)
+    return np.asarray(json.loads(value), dtype=np.float32)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the ``k`` highest scores, best first; ties keep input order."""
+    k = min(k, scores.size)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < scores.size:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(scores.size)
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
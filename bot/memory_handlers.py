@@ -1,6 +1,7 @@
 import logging
 import math
 import os
+from cachetools import TTLCache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
 from .memory import UserMemory
@@ -9,6 +10,8 @@ logger = logging.getLogger(__name__)
 
 FACTS_PER_PAGE = 5
 FACT_LABEL_MAX_LEN = 40
+PENDING_EDIT_TTL_SECONDS = 300
+PENDING_EDITS_MAX = 10_000
 
 ALLOWED_CHAT_IDS: set[int] = {
     int(cid.strip())
@@ -18,8 +21,11 @@ ALLOWED_CHAT_IDS: set[int] = {
 
 user_memory = UserMemory(db_path=os.getenv("DB_PATH", "/app/data/memory.db"))
 
-# Pending edits: (chat_id, user_id) → (fact_id, target_user_id)
-_pending_edits: dict[tuple[int, int], tuple[int, int]] = {}
+# Pending edits: (chat_id, user_id) → (fact_id, target_user_id).
+# Entries expire so an Edit tap that is never answered does not linger.
+_pending_edits: TTLCache = TTLCache(
+    maxsize=PENDING_EDITS_MAX, ttl=PENDING_EDIT_TTL_SECONDS
+)
 
 
 def _truncate(text: str, max_len: int = FACT_LABEL_MAX_LEN) -> str:
@@ -114,18 +120,9 @@ async def handle_memory_callback(update: Update, context: ContextTypes.DEFAULT_T
     if query.message and query.from_user:
         _pending_edits.pop((query.message.chat_id, query.from_user.id), None)
 
-    action = parts[1]
-
-    if action == "list":
-        await _cb_list(query, parts)
-    elif action == "view":
-        await _cb_view(query, parts)
-    elif action == "del":
-        await _cb_delete(query, parts)
-    elif action == "edit":
-        await _cb_edit(query, parts)
-    elif action == "back":
-        await _cb_list(query, parts)
+    handler = _CALLBACK_ACTIONS.get(parts[1])
+    if handler is not None:
+        await handler(query, parts)
 
 
 async def _cb_list(query, parts: list[str]) -> None:
@@ -160,9 +157,7 @@ async def _cb_view(query, parts: list[str]) -> None:
     except (IndexError, ValueError):
         return
 
-    # Fetch the fact to display its full text
-    facts, _ = user_memory.get_user_facts_page(target_user_id, page=0, page_size=9999)
-    fact = next((f for f in facts if f["id"] == fact_id), None)
+    fact = user_memory.get_fact_by_id(fact_id, target_user_id)
 
     if not fact:
         await query.edit_message_text("⚠️ Fact not found — it may have been deleted.")
@@ -231,6 +226,16 @@ async def _cb_edit(query, parts: list[str]) -> None:
     )
 
 
+# Callback action (second `mem:` segment) → handler
+_CALLBACK_ACTIONS = {
+    "list": _cb_list,
+    "back": _cb_list,
+    "view": _cb_view,
+    "del": _cb_delete,
+    "edit": _cb_edit,
+}
+
+
 async def handle_memory_edit_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Capture a text message if the user has a pending edit.
 
@@ -248,10 +253,11 @@ async def handle_memory_edit_reply(update: Update, context: ContextTypes.DEFAULT
     chat_id = update.message.chat_id
     key = (chat_id, user.id)
 
-    if key not in _pending_edits:
+    entry = _pending_edits.pop(key, None)
+    if entry is None:
         return False
 
-    fact_id, target_user_id = _pending_edits.pop(key)
+    fact_id, target_user_id = entry
     new_text = update.message.text.strip()
 
     if not new_text:
@@ -5,6 +5,9 @@ class SessionManager:
     def __init__(self, max_messages: int = 100):
         self.max_messages = max_messages
         self._sessions: dict[int, deque] = {}
+        # Last format_history result per chat; dropped on the chat's next add,
+        # and only ever kept for chats that have a session.
+        self._formatted: dict[int, str] = {}
 
     def add_message(self, chat_id: int, role: str, text: str, author: str | None = None) -> None:
         """Add a message to the session.
@@ -18,6 +21,7 @@ class SessionManager:
         if chat_id not in self._sessions:
             self._sessions[chat_id] = deque(maxlen=self.max_messages)
         self._sessions[chat_id].append({"role": role, "text": text, "author": author})
+        self._formatted.pop(chat_id, None)
 
     def get_history(self, chat_id: int) -> list[dict]:
         """Return the raw structured history for a chat."""
@@ -27,9 +31,15 @@ class SessionManager:
 
     def format_history(self, chat_id: int) -> str:
         """Return a flat text representation (used by extract_profile)."""
-        entries = self.get_history(chat_id)
-        return "\n".join(
+        cached = self._formatted.get(chat_id)
+        if cached is not None:
+            return cached
+        if chat_id not in self._sessions:
+            return ""
+        text = "\n".join(
             f"[{e['author'] or 'user'}]: {e['text']}" if e["role"] == "user"
             else f"[bot]: {e['text']}"
-            for e in entries
+            for e in self._sessions[chat_id]
         )
+        self._formatted[chat_id] = text
+        return text
@@ -4,30 +4,120 @@ import tempfile
 # Set DB_PATH before any bot module is imported — prevents PermissionError
 # when bot.handlers tries to create /app/data/ on macOS during tests
 os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "test_memory.db"))
+# xdist workers inherit the controller's DB_PATH; give each its own file so the
+# autouse reset below cannot wipe rows another worker is still using.
+if os.environ.get("PYTEST_XDIST_WORKER"):
+    os.environ["DB_PATH"] = os.path.join(
+        tempfile.mkdtemp(), f"test_memory_{os.environ['PYTEST_XDIST_WORKER']}.db"
+    )
+
+import sqlite3
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
 
 import pytest
 from alembic.config import Config
 from alembic import command
 
-# Run alembic migrations on the test database once before tests
-alembic_cfg = Config("alembic.ini")
-# Override the sqlalchemy.url to point to our temp test DB
-alembic_cfg.set_main_option("sqlalchemy.url", f"sqlite:///{os.environ['DB_PATH']}")
-command.upgrade(alembic_cfg, "head")
+from bot.handlers import user_memory
+from bot.memory import UserMemory
+from bot.session import SessionManager
 
-@pytest.fixture(autouse=True)
-def reset_user_memory_db():
-    """Reset the shared user_memory DB between tests to prevent state leakage."""
-    import sqlite3
-    from bot.handlers import user_memory
-    with sqlite3.connect(user_memory.db_path) as conn:
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
+def _migrate(db_path: str) -> None:
+    alembic_cfg = Config("alembic.ini")
+    alembic_cfg.set_main_option("sqlalchemy.url", f"sqlite:///{db_path}")
+    command.upgrade(alembic_cfg, "head")
+
+
+def _clear_memory_tables(db_path: str) -> None:
+    with sqlite3.connect(db_path) as conn:
         conn.execute("DELETE FROM user_profiles")
         conn.execute("DELETE FROM chat_memberships")
         conn.execute("DELETE FROM memory_facts")
         conn.commit()
+
+
+# Run alembic migrations on the test database once before tests
+_migrate(os.environ["DB_PATH"])
+
+
+if uvloop is not None:
+    def pytest_asyncio_loop_factories(config, item):
+        """Run async tests on uvloop; handler tests are mostly loop scheduling."""
+        return {"uvloop": uvloop.new_event_loop}
+
+
+@pytest.fixture(autouse=True)
+def reset_user_memory_db():
+    """Reset the shared user_memory DB between tests to prevent state leakage."""
+    _clear_memory_tables(user_memory.db_path)
     yield
-    with sqlite3.connect(user_memory.db_path) as conn:
-        conn.execute("DELETE FROM user_profiles")
-        conn.execute("DELETE FROM chat_memberships")
-        conn.execute("DELETE FROM memory_facts")
-        conn.commit()
+    _clear_memory_tables(user_memory.db_path)
+
+
+@pytest.fixture(autouse=True)
+def fresh_session_manager(monkeypatch):
+    """Give each test an empty chat history instead of the process-wide one."""
+    monkeypatch.setattr("bot.handlers.session_manager", SessionManager())
+
+
+@pytest.fixture(scope="session")
+def migrated_db(tmp_path_factory):
+    """A standalone database migrated once per session for UserMemory tests."""
+    db_path = str(tmp_path_factory.mktemp("db") / "test.db")
+    _migrate(db_path)
+    return db_path
+
+
+@pytest.fixture
+def mem(migrated_db):
+    _clear_memory_tables(migrated_db)
+    memory = UserMemory(db_path=migrated_db)
+    yield memory
+    memory.close()
+
+
+@pytest.fixture(scope="session")
+def update_factory():
+    """Build a minimal telegram Update carrying a text message."""
+    def make_update(
+        text: str,
+        chat_id: int,
+        first_name: str = "Alice",
+        user_id: int = 0,  # default integer id so SQLite binding works
+        chat_type: str = "group",
+    ) -> SimpleNamespace:
+        user = SimpleNamespace(
+            first_name=first_name,
+            username=first_name.lower(),
+            id=user_id,
+        )
+        message = SimpleNamespace(
+            text=text,
+            chat_id=chat_id,
+            from_user=user,
+            reply_text=AsyncMock(return_value=None),
+            reply_to_message=None,
+            chat=SimpleNamespace(type=chat_type),
+        )
+        return SimpleNamespace(message=message)
+
+    return make_update
+
+
+@pytest.fixture(scope="session")
+def context_factory():
+    """Build a handler context whose bot has the given username."""
+    def make_context(bot_username: str = "testbot") -> SimpleNamespace:
+        return SimpleNamespace(
+            bot=SimpleNamespace(
+                username=bot_username, send_chat_action=AsyncMock(return_value=None)
+            )
+        )
+
+    return make_context
@@ -1,177 +1,152 @@
+import json
+
 import pytest
-from unittest.mock import MagicMock, patch
+from types import SimpleNamespace
+from unittest.mock import MagicMock
 from bot.gemini import GeminiClient, SYSTEM_PROMPT, _parse_bot_response
 
 
-# --- _parse_bot_response unit tests ---
+@pytest.fixture(autouse=True)
+def mock_genai(monkeypatch):
+    """Replace genai.Client for every test; returns the client GeminiClient receives."""
+    mock_client = MagicMock()
+    monkeypatch.setattr("bot.gemini.genai.Client", MagicMock(return_value=mock_client))
+    return mock_client
 
-def test_parse_valid_json():
-    answer, save = _parse_bot_response('{"answer": "Hello!", "save_to_profile": false}')
-    assert answer == "Hello!"
-    assert save is False
 
+@pytest.fixture
+def client(mock_genai):
+    """A GeminiClient wired to the mocked genai client."""
+    return GeminiClient(api_key="fake-key")
 
-def test_parse_save_true():
-    answer, save = _parse_bot_response('{"answer": "Got it.", "save_to_profile": true}')
-    assert answer == "Got it."
-    assert save is True
 
+def _resp(text):
+    """Stand-in for a genai response; only ``.text`` is ever read."""
+    return SimpleNamespace(text=text)
 
-def test_parse_ignores_extra_fields():
-    answer, save = _parse_bot_response(
-        '{"answer": "Got it.", "save_to_profile": true, "save_to_memory": true}'
-    )
-    assert answer == "Got it."
-    assert save is True
 
+def _part_texts(call) -> list[str]:
+    """Collect every part text sent to generate_content in ``call``."""
+    contents = call.kwargs.get("contents") or call.args[1]
+    return [part.text for c in contents for part in c.parts]
 
-def test_parse_strips_markdown_fences():
-    raw = '```json\n{"answer": "Hi", "save_to_profile": false}\n```'
-    answer, save = _parse_bot_response(raw)
-    assert answer == "Hi"
-    assert save is False
+
+def _assert_all_contain(call, *needles: str) -> None:
+    texts = _part_texts(call)
+    missing = [needle for needle in needles if not any(needle in text for text in texts)]
+    assert not missing, f"not found in prompt: {missing}"
 
 
-def test_parse_fallback_on_invalid_json():
-    raw = "Sorry, I couldn't understand that."
+# --- _parse_bot_response unit tests ---
+
+@pytest.mark.parametrize(
+    "raw,expected_answer,expected_save",
+    [
+        ('{"answer": "Hello!", "save_to_profile": false}', "Hello!", False),
+        ('{"answer": "Got it.", "save_to_profile": true}', "Got it.", True),
+        ('{"answer": "Got it.", "save_to_profile": true, "save_to_memory": true}', "Got it.", True),
+        ('```json\n{"answer": "Hi", "save_to_profile": false}\n```', "Hi", False),
+        ("Sorry, I couldn't understand that.", "Sorry, I couldn't understand that.", False),
+    ],
+    ids=["valid_json", "save_true", "ignores_extra_fields", "strips_markdown_fences", "fallback_on_invalid_json"],
+)
+def test_parse_bot_response(raw, expected_answer, expected_save):
     answer, save = _parse_bot_response(raw)
-    assert answer == raw
-    assert save is False
+    assert answer == expected_answer
+    assert save is expected_save
+
+
+def test_parse_uses_stdlib_json_without_orjson(monkeypatch):
+    monkeypatch.setattr("bot.gemini._json_loads", json.loads)
+    assert _parse_bot_response('{"answer": "Hi", "save_to_profile": true}') == ("Hi", True)
+    assert _parse_bot_response("plain text") == ("plain text", False)
 
 
 # --- GeminiClient.ask() tests ---
 
-@patch("bot.gemini.genai.Client")
-def test_ask_calls_generate_content(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"answer": "Paris is the capital of France.", "save_to_profile": false}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_calls_generate_content(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Paris is the capital of France.", "save_to_profile": false}')
 
-    client = GeminiClient(api_key="fake-key")
     answer, save = client.ask(history=[], question="What's the capital of France?")
 
     assert answer == "Paris is the capital of France."
     assert save is False
-    mock_client.models.generate_content.assert_called_once()
+    mock_genai.models.generate_content.assert_called_once()
 
 
-@patch("bot.gemini.genai.Client")
-def test_ask_includes_history_in_prompt(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"answer": "Some answer", "save_to_profile": false}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_reuses_search_config_across_calls(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Hi", "save_to_profile": false}')
+
+    client.ask(history=[], question="one")
+    client.ask(history=[], question="two")
+
+    first, second = (c.kwargs["config"] for c in mock_genai.models.generate_content.call_args_list)
+    assert first is second
+    assert first.tools[0].google_search is not None
+    assert first.system_instruction == SYSTEM_PROMPT
+
+
+def test_ask_includes_history_in_prompt(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Some answer", "save_to_profile": false}')
 
-    client = GeminiClient(api_key="fake-key")
     client.ask(
         history=[{"role": "user", "text": "test history"}],
         question="test question",
     )
 
-    call_kwargs = mock_client.models.generate_content.call_args
-    contents = call_kwargs.kwargs.get("contents") or call_kwargs.args[1]
-    all_texts = " ".join(part.text for c in contents for part in c.parts)
-    assert "test history" in all_texts
-    assert "test question" in all_texts
+    _assert_all_contain(
+        mock_genai.models.generate_content.call_args, "test history", "test question"
+    )
 
 
-@patch("bot.gemini.genai.Client")
-def test_ask_with_empty_history(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"answer": "Hello!", "save_to_profile": false}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_with_empty_history(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Hello!", "save_to_profile": false}')
 
-    client = GeminiClient(api_key="fake-key")
     answer, save = client.ask(history=[], question="Say hello")
 
     assert answer == "Hello!"
     assert save is False
-    call_kwargs = mock_client.models.generate_content.call_args
+    call_kwargs = mock_genai.models.generate_content.call_args
     contents = call_kwargs.kwargs["contents"]
     assert len(contents) == 1
     assert contents[0].parts[0].text == "Say hello"
 
 
-@patch("bot.gemini.genai.Client")
-def test_ask_raises_on_none_response(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = None
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_raises_on_none_response(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp(None)
 
-    client = GeminiClient(api_key="fake-key")
     with pytest.raises(ValueError, match="no text response"):
         client.ask(history=[], question="test")
 
 
-@patch("bot.gemini.genai.Client")
-def test_ask_includes_user_profile_in_prompt(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"answer": "Answer", "save_to_profile": false}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_includes_user_profile_in_prompt(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Answer", "save_to_profile": false}')
 
-    client = GeminiClient(api_key="fake-key")
     client.ask(history=[], question="What should I eat?", user_profile="Alice loves Italian food.")
 
-    call_kwargs = mock_client.models.generate_content.call_args
-    contents = call_kwargs.kwargs.get("contents") or call_kwargs.args[1]
-    all_texts = " ".join(part.text for c in contents for part in c.parts)
-    assert "Alice loves Italian food." in all_texts
+    _assert_all_contain(mock_genai.models.generate_content.call_args, "Alice loves Italian food.")
 
 
-@patch("bot.gemini.genai.Client")
-def test_ask_without_profile_omits_profile_section(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"answer": "Answer", "save_to_profile": false}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_without_profile_omits_profile_section(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Answer", "save_to_profile": false}')
 
-    client = GeminiClient(api_key="fake-key")
     client.ask(history=[], question="Hello", user_profile="", chat_members=[])
 
-    call_kwargs = mock_client.models.generate_content.call_args
-    contents = call_kwargs.kwargs.get("contents") or call_kwargs.args[1]
-    all_texts = " ".join(part.text for c in contents for part in c.parts)
-    assert "Profile" not in all_texts
-    assert "Members" not in all_texts
+    texts = _part_texts(mock_genai.models.generate_content.call_args)
+    assert not any("Profile" in text or "Members" in text for text in texts)
 
 
-@patch("bot.gemini.genai.Client")
-def test_ask_includes_chat_members_in_prompt(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"answer": "Answer", "save_to_profile": false}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_includes_chat_members_in_prompt(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Answer", "save_to_profile": false}')
 
-    client = GeminiClient(api_key="fake-key")
     client.ask(history=[], question="Who's here?", user_profile="", chat_members=["Alice", "Bob"])
 
-    call_kwargs = mock_client.models.generate_content.call_args
-    contents = call_kwargs.kwargs.get("contents") or call_kwargs.args[1]
-    all_texts = " ".join(part.text for c in contents for part in c.parts)
-    assert "Alice" in all_texts
-    assert "Bob" in all_texts
+    _assert_all_contain(mock_genai.models.generate_content.call_args, "Alice", "Bob")
 
 
-@patch("bot.gemini.genai.Client")
-def test_ask_history_roles_are_preserved(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"answer": "Sure!", "save_to_profile": false}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_history_roles_are_preserved(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Sure!", "save_to_profile": false}')
 
-    client = GeminiClient(api_key="fake-key")
     client.ask(
         history=[
             {"role": "user", "text": "Hello"},
@@ -180,58 +155,64 @@ def test_ask_history_roles_are_preserved(mock_client_cls):
         question="How are you?",
     )
 
-    call_kwargs = mock_client.models.generate_content.call_args
+    call_kwargs = mock_genai.models.generate_content.call_args
     contents = call_kwargs.kwargs.get("contents") or call_kwargs.args[1]
     roles = [c.role for c in contents]
     assert roles == ["user", "model", "user"]
 
 
-@patch("bot.gemini.genai.Client")
-def test_ask_save_to_profile_true(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"answer": "Got it, noted!", "save_to_profile": true}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_ask_places_context_before_history(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Sure!", "save_to_profile": false}')
+
+    client.ask(
+        history=[{"role": "user", "text": "Hello", "author": "Alice"}],
+        question="Anything else?",
+        user_profile="Alice is a nurse.",
+    )
+    contents = mock_genai.models.generate_content.call_args.kwargs["contents"]
+    assert [c.role for c in contents] == ["user", "user"]
+    assert contents[0].parts[0].text.startswith("Profile of the person asking:")
+    assert contents[0].parts[0].text.endswith("[Alice]: Hello")
+
+    client.ask(
+        history=[{"role": "model", "text": "Hi there!"}],
+        question="Anything else?",
+        user_profile="Alice is a nurse.",
+    )
+    contents = mock_genai.models.generate_content.call_args.kwargs["contents"]
+    assert [c.role for c in contents] == ["user", "model", "user"]
+    assert "Alice is a nurse." in contents[0].parts[0].text
+    assert contents[1].parts[0].text == "[bot]: Hi there!"
+
+
+def test_ask_save_to_profile_true(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"answer": "Got it, noted!", "save_to_profile": true}')
 
-    client = GeminiClient(api_key="fake-key")
     answer, save = client.ask(history=[], question="Remember that I am a pilot")
 
     assert answer == "Got it, noted!"
     assert save is True
 
 
-@patch("bot.gemini.genai.Client")
-def test_extract_profile_returns_text(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = "Alice is a nurse who likes hiking."
-    mock_client.models.generate_content.return_value = mock_response
+def test_extract_profile_returns_text(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp("Alice is a nurse who likes hiking.")
 
-    client = GeminiClient(api_key="fake-key")
     result = client.extract_profile(
         existing_profile="",
         recent_history="[user]: I just got back from a hike",
         user_name="Alice",
     )
     assert result == "Alice is a nurse who likes hiking."
-    mock_client.models.generate_content.assert_called_once()
+    mock_genai.models.generate_content.assert_called_once()
 
 
-@patch("bot.gemini.genai.Client")
-def test_extract_facts_returns_structured_list(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = (
+def test_extract_facts_returns_structured_list(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp(
         '[{"fact":"Alice prefers concise answers","importance":0.9,"confidence":0.95,'
         '"scope":"user"},{"fact":"This chat uses Ukrainian","importance":0.7,'
         '"confidence":0.9,"scope":"chat"}]'
     )
-    mock_client.models.generate_content.return_value = mock_response
 
-    client = GeminiClient(api_key="fake-key")
     facts = client.extract_facts(
         existing_facts=["Alice likes short replies."],
         recent_history="[Alice]: Please keep it short and in Ukrainian",
@@ -242,15 +223,9 @@ def test_extract_facts_returns_structured_list(mock_client_cls):
     assert facts[1]["scope"] == "chat"
 
 
-@patch("bot.gemini.genai.Client")
-def test_extract_facts_falls_back_to_empty_list_on_invalid_json(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = "No new facts."
-    mock_client.models.generate_content.return_value = mock_response
+def test_extract_facts_falls_back_to_empty_list_on_invalid_json(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp("No new facts.")
 
-    client = GeminiClient(api_key="fake-key")
     facts = client.extract_facts(
         existing_facts=[],
         recent_history="[Alice]: hello",
@@ -258,15 +233,40 @@ def test_extract_facts_falls_back_to_empty_list_on_invalid_json(mock_client_cls)
     )
     assert facts == []
 
-@patch("bot.gemini.genai.Client")
-def test_decide_fact_action_returns_update_for_valid_target(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"action":"update_existing","target_fact_id":11}'
-    mock_client.models.generate_content.return_value = mock_response
 
-    client = GeminiClient(api_key="fake-key")
+def test_extract_facts_batch_returns_facts_per_user(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp(
+        '{"1":[{"fact":"Alice is a nurse","importance":0.8,"confidence":0.9,"scope":"user"}],'
+        '"2":[],"999":[{"fact":"Unknown user fact"}]}'
+    )
+
+    facts = client.extract_facts_batch(
+        users=[(1, "Alice", []), (2, "Bob", ["Bob likes tea"])],
+        recent_history="[Alice]: I work night shifts at the hospital",
+    )
+    assert facts == {
+        1: [{"fact": "Alice is a nurse", "importance": 0.8, "confidence": 0.9, "scope": "user"}]
+    }
+    mock_genai.models.generate_content.assert_called_once()
+    config = mock_genai.models.generate_content.call_args.kwargs["config"]
+    assert config.response_mime_type == "application/json"
+    assert set(config.response_schema.properties) == {"1", "2"}
+    assert config.response_schema.required == ["1", "2"]
+
+
+def test_extract_facts_batch_falls_back_to_empty_dict_on_invalid_json(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp("No new facts.")
+
+    facts = client.extract_facts_batch(
+        users=[(1, "Alice", [])],
+        recent_history="[Alice]: hello",
+    )
+    assert facts == {}
+
+
+def test_decide_fact_action_returns_update_for_valid_target(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"action":"update_existing","target_fact_id":11}')
+
     decision = client.decide_fact_action(
         candidate_fact="Alice plans around 2.5 kW solar panels.",
         scope="user",
@@ -278,15 +278,9 @@ def test_decide_fact_action_returns_update_for_valid_target(mock_client_cls):
     assert decision == {"action": "update_existing", "target_fact_id": 11}
 
 
-@patch("bot.gemini.genai.Client")
-def test_decide_fact_action_falls_back_when_target_not_in_candidates(mock_client_cls):
-    mock_client = MagicMock()
-    mock_client_cls.return_value = mock_client
-    mock_response = MagicMock()
-    mock_response.text = '{"action":"update_existing","target_fact_id":999}'
-    mock_client.models.generate_content.return_value = mock_response
+def test_decide_fact_action_falls_back_when_target_not_in_candidates(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp('{"action":"update_existing","target_fact_id":999}')
 
-    client = GeminiClient(api_key="fake-key")
     decision = client.decide_fact_action(
         candidate_fact="Alice plans around 2.5 kW solar panels.",
         scope="user",
@@ -298,6 +292,23 @@ def test_decide_fact_action_falls_back_when_target_not_in_candidates(mock_client
     assert decision == {"action": "keep_add_new", "target_fact_id": None}
 
 
+def test_decide_fact_action_accepts_fenced_json(client, mock_genai):
+    mock_genai.models.generate_content.return_value = _resp(
+        '```json\n{"action":"deactivate_existing","target_fact_id":11}\n```'
+    )
+
+    decision = client.decide_fact_action(
+        candidate_fact="Alice no longer plans solar panels.",
+        scope="user",
+        similar_facts=[
+            {"fact_id": 11, "fact_text": "Alice plans 5 kW solar panels.", "similarity": 0.93}
+        ],
+        user_name="Alice",
+    )
+    assert decision == {"action": "deactivate_existing", "target_fact_id": 11}
+
+
 def test_system_prompt_requires_optional_memory_usage():
     assert "ONLY when they are relevant" in SYSTEM_PROMPT
     assert "Do not force these facts" in SYSTEM_PROMPT
+
@@ -1,100 +1,176 @@
 import asyncio
+import threading
 import pytest
+from types import SimpleNamespace
 from unittest.mock import AsyncMock, MagicMock, patch
-from telegram import Update, Message, User, Chat
-from telegram.ext import ContextTypes
 
+from telegram.error import NetworkError, RetryAfter, TimedOut
 
-def make_update(text: str, chat_id: int, first_name: str = "Alice") -> Update:
-    user = MagicMock(spec=User)
-    user.first_name = first_name
-    user.username = first_name.lower()
-    user.id = 0  # default integer id so SQLite binding works
+from bot import handlers
 
-    message = MagicMock(spec=Message)
-    message.text = text
-    message.chat_id = chat_id
-    message.from_user = user
-    message.reply_text = AsyncMock()
+_LONG_TEXT = "A" * 5000
 
-    update = MagicMock(spec=Update)
-    update.message = message
-    return update
 
+@pytest.fixture
+def gemini_stub(monkeypatch):
+    """Preconfigured gemini_client for the fact-extraction path."""
+    stub = SimpleNamespace(
+        extract_facts=MagicMock(return_value=[{"fact": "Eve is a pilot", "scope": "user"}]),
+        embed_text=MagicMock(return_value=[0.1, 0.2, 0.3]),
+        decide_fact_action=MagicMock(
+            return_value={"action": "update_existing", "target_fact_id": 5}
+        ),
+    )
+    monkeypatch.setattr("bot.handlers.gemini_client", stub)
+    return stub
 
-def make_context(bot_username: str = "testbot") -> ContextTypes.DEFAULT_TYPE:
-    context = MagicMock(spec=ContextTypes.DEFAULT_TYPE)
-    context.bot = MagicMock()
-    context.bot.username = bot_username
-    return context
 
+class AlwaysInSet:
+    def __contains__(self, _):
+        return True
 
-@pytest.mark.asyncio
-async def test_ignores_disallowed_chat():
-    from bot.handlers import handle_message
-    update = make_update("hello", chat_id=9999)
-    context = make_context()
 
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {1}):
-        await handle_message(update, context)
+@pytest.fixture(autouse=True)
+def _allow_all_chats(monkeypatch):
+    monkeypatch.setattr("bot.handlers.ALLOWED_CHAT_IDS", AlwaysInSet())
+
+
+@pytest.fixture(autouse=True)
+def _clear_profile_update_queue():
+    """Keep queued profile refreshes and their flush tasks from leaking between tests."""
+    yield
+    for task in handlers._profile_flush_tasks.values():
+        task.cancel()
+    handlers._profile_flush_tasks.clear()
+    handlers._active_profile_flushes.clear()
+    handlers._pending_profile_updates.clear()
+
+
+@pytest.fixture
+def mock_gemini():
+    with patch("bot.handlers.gemini_client") as mock:
+        yield mock
+
+
+@pytest.fixture
+def mock_memory():
+    """Patched user_memory with empty defaults; tests override what they need."""
+    with patch("bot.handlers.user_memory") as mock:
+        mock.increment_message_count.return_value = 1
+        mock.get_profile.return_value = ""
+        mock.get_user_facts.return_value = []
+        mock.get_chat_members.return_value = []
+        mock.search_facts_by_embedding.return_value = []
+        mock.find_similar_facts.return_value = []
+        yield mock
+
+
+async def test_ignores_disallowed_chat(monkeypatch, update_factory, context_factory):
+    update = update_factory("hello", chat_id=9999)
+    context = context_factory()
+
+    monkeypatch.setattr("bot.handlers.ALLOWED_CHAT_IDS", {1})
+    await handlers.handle_message(update, context)
 
     update.message.reply_text.assert_not_called()
 
 
-@pytest.mark.asyncio
-async def test_stores_message_without_tag():
-    from bot.handlers import handle_message, session_manager
-    update = make_update("just chatting", chat_id=1)
-    context = make_context()
+@pytest.mark.parametrize("attr", ["text", "from_user"], ids=["no_text", "no_user"])
+async def test_returns_early_without_text_or_user(
+    attr, mock_memory, update_factory, context_factory,
+):
+    update = update_factory("@testbot hello", chat_id=12)
+    setattr(update.message, attr, None)
+    context = context_factory()
 
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {1}):
-        await handle_message(update, context)
+    with patch("bot.handlers.session_manager") as mock_session:
+        await handlers.handle_message(update, context)
 
+    mock_session.add_message.assert_not_called()
+    mock_memory.increment_message_count.assert_not_called()
     update.message.reply_text.assert_not_called()
-    history = session_manager.get_history(1)
+
+
+async def test_stores_message_without_tag(update_factory, context_factory):
+    update = update_factory("just chatting", chat_id=1)
+    context = context_factory()
+
+    await handlers.handle_message(update, context)
+
+    update.message.reply_text.assert_not_called()
+    history = handlers.session_manager.get_history(1)
     assert any("just chatting" in msg["text"] for msg in history)
 
 
-@pytest.mark.asyncio
-async def test_replies_when_tagged():
-    from bot.handlers import handle_message
-    update = make_update("@testbot what time is it?", chat_id=2)
-    context = make_context(bot_username="testbot")
+async def test_stores_bot_response_in_session(
+    mock_gemini, mock_memory, update_factory, context_factory,
+):
+    update = update_factory("@testbot say hi", chat_id=11)
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("Hi!", False)
+    calls = []
+
+    with patch("bot.handlers.session_manager") as mock_session:
+        mock_session.add_message.side_effect = lambda *a, **kw: calls.append((a, kw))
+        await handlers.handle_message(update, context)
+
+    model_calls = [c for c in calls if c[0][1] == "model"]
+    assert model_calls == [((11, "model", "Hi!"), {"author": "testbot"})]
 
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {2}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.return_value = ("It's noon!", False)
-            await handle_message(update, context)
 
-    update.message.reply_text.assert_called_once_with("It's noon!")
+async def test_splits_long_response(mock_gemini, mock_memory, update_factory, context_factory):
+    update = update_factory("@testbot write an essay", chat_id=13)
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = (_LONG_TEXT, False)
 
+    await handlers.handle_message(update, context)
 
-@pytest.mark.asyncio
-async def test_replies_with_error_on_gemini_failure():
-    from bot.handlers import handle_message
-    update = make_update("@testbot crash?", chat_id=3)
-    context = make_context(bot_username="testbot")
+    chunks = [c.args[0] for c in update.message.reply_text.call_args_list]
+    assert [len(chunk) for chunk in chunks] == [4096, 904]
+    assert "".join(chunks) == _LONG_TEXT
 
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {3}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.side_effect = Exception("API error")
-            await handle_message(update, context)
+
+async def test_replies_with_error_on_gemini_failure(mock_gemini, update_factory, context_factory):
+    update = update_factory("@testbot crash?", chat_id=3)
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.side_effect = Exception("API error")
+
+    await handlers.handle_message(update, context)
 
     update.message.reply_text.assert_called_once()
     args = update.message.reply_text.call_args[0][0]
     assert "wrong" in args.lower() or "error" in args.lower() or "sorry" in args.lower()
 
 
-@pytest.mark.asyncio
-async def test_strips_bot_mention_from_question():
-    from bot.handlers import handle_message
-    update = make_update("@testbot what is 2+2?", chat_id=4)
-    context = make_context(bot_username="testbot")
+@pytest.mark.parametrize(
+    "failures,expected_calls,raises",
+    [
+        ([RetryAfter(0)], 2, None),
+        ([NetworkError("reset")], 2, None),
+        ([RetryAfter(0)] * 3, 3, RetryAfter),
+        ([TimedOut()], 1, TimedOut),
+    ],
+    ids=["flood_control", "network_error", "gives_up", "timed_out_not_retried"],
+)
+async def test_reply_text_retries_transient_errors(monkeypatch, failures, expected_calls, raises):
+    monkeypatch.setattr(handlers, "REPLY_RETRY_BASE_DELAY", 0.0)
+    message = SimpleNamespace(reply_text=AsyncMock(side_effect=[*failures, None]))
+
+    if raises:
+        with pytest.raises(raises):
+            await handlers._reply_text(message, "hi")
+    else:
+        await handlers._reply_text(message, "hi")
+
+    assert message.reply_text.await_count == expected_calls
+
 
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {4}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.return_value = ("4", False)
-            await handle_message(update, context)
+async def test_strips_bot_mention_from_question(mock_gemini, update_factory, context_factory):
+    update = update_factory("@testbot what is 2+2?", chat_id=4)
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("4", False)
+
+    await handlers.handle_message(update, context)
 
     call_kwargs = mock_gemini.ask.call_args.kwargs
     question = call_kwargs.get("question") or mock_gemini.ask.call_args.args[1]
@@ -102,173 +178,299 @@ async def test_strips_bot_mention_from_question():
     assert "2+2" in question
 
 
-@pytest.mark.asyncio
-async def test_increments_user_message_count():
-    from bot.handlers import handle_message, user_memory
-    update = make_update("hello there", chat_id=10, first_name="TestUser")
+async def test_increments_user_message_count(update_factory, context_factory):
+    update = update_factory("hello there", chat_id=10, first_name="TestUser")
     update.message.from_user.id = 42
-    context = make_context()
+    context = context_factory()
 
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {10}):
-        await handle_message(update, context)
+    await handlers.handle_message(update, context)
 
-    profile = user_memory.get_profile(user_id=42)
+    profile = handlers.user_memory.get_profile(user_id=42)
     assert isinstance(profile, str)
 
 
-@pytest.mark.asyncio
-async def test_passes_user_profile_to_gemini():
-    from bot.handlers import handle_message, user_memory
-    user_memory.increment_message_count(99, 5, "bob", "Bob")  # create row first
-    user_memory.update_profile(user_id=99, profile="Bob is a chef.")
-    update = make_update("@testbot what should I cook?", chat_id=5, first_name="Bob")
+async def test_passes_user_profile_to_gemini(mock_gemini, update_factory, context_factory):
+    handlers.user_memory.increment_message_count(99, 5, "bob", "Bob")  # create row first
+    handlers.user_memory.update_profile(user_id=99, profile="Bob is a chef.")
+    update = update_factory("@testbot what should I cook?", chat_id=5, first_name="Bob")
     update.message.from_user.id = 99
-    context = make_context(bot_username="testbot")
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("Try pasta!", False)
 
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {5}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.return_value = ("Try pasta!", False)
-            await handle_message(update, context)
+    await handlers.handle_message(update, context)
 
     call_kwargs = mock_gemini.ask.call_args.kwargs
     profile = call_kwargs.get("user_profile") or ""
     assert "Bob is a chef." in profile
 
 
-@pytest.mark.asyncio
-async def test_save_to_profile_triggers_immediate_profile_update():
+async def test_save_to_profile_triggers_immediate_profile_update(
+    mock_gemini, mock_memory, update_factory, context_factory,
+):
     """When the model sets save_to_profile=True, _update_user_profile is called."""
-    from bot.handlers import handle_message
-    update = make_update("@testbot remember that I am a pilot", chat_id=6, first_name="Eve")
+    update = update_factory("@testbot remember that I am a pilot", chat_id=6, first_name="Eve")
     update.message.from_user.id = 77
-    context = make_context(bot_username="testbot")
-
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {6}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.return_value = ("Got it, I'll remember that!", True)
-            with patch("bot.handlers.user_memory") as mock_memory:
-                mock_memory.increment_message_count.return_value = 1
-                mock_memory.get_profile.return_value = ""
-                mock_memory.get_user_facts.return_value = []
-                mock_memory.get_chat_members.return_value = []
-                mock_memory.search_facts_by_embedding.return_value = []
-                with patch("bot.handlers._update_user_profile", new_callable=AsyncMock) as mock_update:
-                    await handle_message(update, context)
-                    mock_update.assert_awaited_once()
-
-
-@pytest.mark.asyncio
-async def test_no_profile_update_when_save_false():
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("Got it, I'll remember that!", True)
+
+    with patch("bot.handlers._update_user_profile", new_callable=AsyncMock) as mock_update:
+        await handlers.handle_message(update, context)
+
+    mock_update.assert_awaited_once()
+
+
+async def test_no_profile_update_when_save_false(
+    mock_gemini, mock_memory, update_factory, context_factory,
+):
     """When save_to_profile=False, _update_user_profile is NOT called eagerly."""
-    from bot.handlers import handle_message
-    update = make_update("@testbot what's 2+2?", chat_id=7, first_name="Alice")
+    update = update_factory("@testbot what's 2+2?", chat_id=7, first_name="Alice")
     update.message.from_user.id = 88
-    context = make_context(bot_username="testbot")
-
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {7}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.return_value = ("4", False)
-            with patch("bot.handlers.user_memory") as mock_memory:
-                mock_memory.increment_message_count.return_value = 1
-                mock_memory.get_profile.return_value = ""
-                mock_memory.get_user_facts.return_value = []
-                mock_memory.get_chat_members.return_value = []
-                mock_memory.search_facts_by_embedding.return_value = []
-                with patch("bot.handlers._update_user_profile", new_callable=AsyncMock) as mock_update:
-                    await handle_message(update, context)
-                    mock_update.assert_not_awaited()
-
-@pytest.mark.asyncio
-async def test_vector_search_rag_injection():
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("4", False)
+
+    with patch("bot.handlers._update_user_profile", new_callable=AsyncMock) as mock_update:
+        await handlers.handle_message(update, context)
+
+    mock_update.assert_not_awaited()
+
+
+async def test_vector_search_rag_injection(
+    mock_gemini, mock_memory, update_factory, context_factory,
+):
     """Verify that handle_message generates an embedding and performs fact-based search."""
-    from bot.handlers import handle_message
-    update = make_update("@testbot Who loves apples?", chat_id=8, first_name="Dave")
+    update = update_factory("@testbot Who loves apples?", chat_id=8, first_name="Dave")
     update.message.from_user.id = 111
-    context = make_context(bot_username="testbot")
-
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {8}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.return_value = ("Alice does!", False)
-            mock_gemini.embed_text.return_value = [0.1, 0.2, 0.3]
-            with patch("bot.handlers.user_memory") as mock_memory:
-                mock_memory.increment_message_count.return_value = 1
-                mock_memory.get_profile.return_value = ""
-                mock_memory.get_user_facts.return_value = []
-                mock_memory.get_chat_members.return_value = [(1, "Alice")]
-                mock_memory.search_facts_by_embedding.return_value = [
-                    {
-                        "fact_id": 10,
-                        "scope": "user",
-                        "user_id": 1,
-                        "owner_name": "Alice",
-                        "fact_text": "Alice loves apples",
-                        "score": 0.88,
-                    }
-                ]
-                
-                await handle_message(update, context)
-                
-                # Verify embedding was generated for the question
-                mock_gemini.embed_text.assert_called_once_with("Who loves apples?")
-                
-                # Verify fact search was performed with chat/user scope
-                mock_memory.search_facts_by_embedding.assert_called_once_with(
-                    query_embedding=[0.1, 0.2, 0.3],
-                    chat_id=8,
-                    asking_user_id=111,
-                    limit=3,
-                )
-                
-                # Verify retrieved facts were passed to ask()
-                call_kwargs = mock_gemini.ask.call_args.kwargs
-                retrieved = call_kwargs.get("retrieved_profiles")
-                assert retrieved == ["[user fact] Alice [ID: 1]: Alice loves apples"]
-                mock_memory.mark_facts_used.assert_called_once_with([10])
-
-
-@pytest.mark.asyncio
-async def test_memory_not_injected_when_no_relevant_facts():
-    from bot.handlers import handle_message
-    update = make_update("@testbot explain docker layers", chat_id=81, first_name="Sam")
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("Alice does!", False)
+    mock_gemini.embed_text.return_value = [0.1, 0.2, 0.3]
+    mock_memory.get_chat_members.return_value = [(1, "Alice")]
+    mock_memory.search_facts_by_embedding.return_value = [
+        {
+            "fact_id": 10,
+            "scope": "user",
+            "user_id": 1,
+            "owner_name": "Alice",
+            "fact_text": "Alice loves apples",
+            "score": 0.88,
+        }
+    ]
+
+    await handlers.handle_message(update, context)
+
+    # Verify embedding was generated for the question
+    mock_gemini.embed_text.assert_called_once_with("Who loves apples?")
+
+    # Verify fact search was performed with chat/user scope
+    mock_memory.search_facts_by_embedding.assert_called_once_with(
+        query_embedding=[0.1, 0.2, 0.3],
+        chat_id=8,
+        asking_user_id=111,
+        limit=3,
+    )
+
+    # Verify retrieved facts were passed to ask()
+    call_kwargs = mock_gemini.ask.call_args.kwargs
+    retrieved = call_kwargs.get("retrieved_profiles")
+    assert retrieved == ["[user fact] Alice [ID: 1]: Alice loves apples"]
+    mock_memory.mark_facts_used.assert_called_once_with([10])
+
+
+async def test_memory_not_injected_when_no_relevant_facts(
+    mock_gemini, mock_memory, update_factory, context_factory,
+):
+    update = update_factory("@testbot explain docker layers", chat_id=81, first_name="Sam")
     update.message.from_user.id = 812
-    context = make_context(bot_username="testbot")
-
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {81}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.return_value = ("Use smaller base images.", False)
-            mock_gemini.embed_text.return_value = [0.4, 0.1, 0.5]
-            with patch("bot.handlers.user_memory") as mock_memory:
-                mock_memory.increment_message_count.return_value = 1
-                mock_memory.get_profile.return_value = ""
-                mock_memory.get_user_facts.return_value = []
-                mock_memory.get_chat_members.return_value = [(812, "Sam")]
-                mock_memory.search_facts_by_embedding.return_value = []
-
-                await handle_message(update, context)
-
-                call_kwargs = mock_gemini.ask.call_args.kwargs
-                assert call_kwargs.get("retrieved_profiles") is None
-                mock_memory.mark_facts_used.assert_not_called()
-
-
-@pytest.mark.asyncio
-async def test_sends_typing_action():
-    from bot.handlers import handle_message
-    update = make_update("@testbot tell me a story", chat_id=123, first_name="Dave")
-    context = make_context(bot_username="testbot")
-    context.bot.send_chat_action = AsyncMock()
-
-    with patch("bot.handlers.ALLOWED_CHAT_IDS", {123}):
-        with patch("bot.handlers.gemini_client") as mock_gemini:
-            mock_gemini.ask.return_value = ("Once upon a time...", False)
-            
-            # Use a side_effect that actually yields control
-            original_sleep = asyncio.sleep
-            async def fast_sleep(n):
-                await original_sleep(0)
-
-            with patch("bot.handlers.asyncio.sleep", side_effect=fast_sleep):
-                await handle_message(update, context)
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("Use smaller base images.", False)
+    mock_gemini.embed_text.return_value = [0.4, 0.1, 0.5]
+    mock_memory.get_chat_members.return_value = [(812, "Sam")]
+
+    await handlers.handle_message(update, context)
+
+    call_kwargs = mock_gemini.ask.call_args.kwargs
+    assert call_kwargs.get("retrieved_profiles") is None
+    mock_memory.mark_facts_used.assert_not_called()
+
+
+async def test_sends_typing_action(mock_gemini, update_factory, context_factory):
+    update = update_factory("@testbot tell me a story", chat_id=123, first_name="Dave")
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("Once upon a time...", False)
+
+    # The typing task sends once before its first sleep and is cancelled as
+    # soon as ask() returns, so the real asyncio.sleep never has to elapse.
+    await handlers.handle_message(update, context)
 
     # Verify typing action was sent
     context.bot.send_chat_action.assert_called_with(chat_id=123, action="typing")
+
+
+async def test_update_user_profile_resolves_similar_facts(gemini_stub):
+    memory = handlers.user_memory
+    memory.increment_message_count(77, 6, "eve", "Eve")
+    memory.upsert_user_facts(
+        user_id=77, chat_id=6, facts=[{"fact": "Eve flies planes", "embedding": [0.1, 0.2, 0.3]}]
+    )
+    [existing] = memory.find_similar_facts(scope="user", user_id=77, query_embedding=[0.1, 0.2, 0.3])
+    gemini_stub.decide_fact_action.return_value = {
+        "action": "update_existing",
+        "target_fact_id": existing["fact_id"],
+    }
+
+    await handlers._update_user_profile(77, 6, "Eve")
+
+    similar = gemini_stub.decide_fact_action.call_args.kwargs["similar_facts"]
+    assert [f["fact_id"] for f in similar] == [existing["fact_id"]]
+    assert memory.get_fact_by_id(existing["fact_id"], user_id=77)["fact_text"] == "Eve is a pilot"
+    assert memory.get_user_facts(user_id=77) == ["Eve is a pilot"]  # updated in place, no duplicate
+
+
+async def test_schedule_profile_update_coalesces_users_per_chat():
+    with patch("bot.handlers.PROFILE_UPDATE_BATCH_DELAY", 0), \
+            patch("bot.handlers._update_user_profiles_batch", new_callable=AsyncMock) as mock_batch:
+        handlers._schedule_profile_update(1, 500, "Alice [ID: 1]")
+        handlers._schedule_profile_update(2, 500, "Bob [ID: 2]")
+        assert len(handlers._profile_flush_tasks) == 1
+        await handlers._profile_flush_tasks[500]
+
+    mock_batch.assert_awaited_once_with(500, {1: "Alice [ID: 1]", 2: "Bob [ID: 2]"})
+    assert 500 not in handlers._pending_profile_updates
+    assert 500 not in handlers._profile_flush_tasks
+
+
+async def test_flush_single_user_uses_single_extraction():
+    handlers._pending_profile_updates[501] = {3: "Carol [ID: 3]"}
+    mock_single, mock_batch = AsyncMock(), AsyncMock()
+    with patch.multiple(
+        "bot.handlers",
+        PROFILE_UPDATE_BATCH_DELAY=0,
+        _update_user_profile=mock_single,
+        _update_user_profiles_batch=mock_batch,
+    ):
+        await handlers._flush_profile_updates(501)
+
+    mock_single.assert_awaited_once_with(3, 501, "Carol [ID: 3]")
+    mock_batch.assert_not_awaited()
+
+
+async def test_shutdown_flush_runs_queued_updates_immediately():
+    mock_single, mock_batch = AsyncMock(), AsyncMock()
+    with patch.multiple(
+        "bot.handlers",
+        PROFILE_UPDATE_BATCH_DELAY=3600,
+        _update_user_profile=mock_single,
+        _update_user_profiles_batch=mock_batch,
+    ):
+        handlers._schedule_profile_update(4, 502, "Dan [ID: 4]")
+        handlers._schedule_profile_update(5, 503, "Eve [ID: 5]")
+        handlers._schedule_profile_update(6, 503, "Fay [ID: 6]")
+        waiting = list(handlers._profile_flush_tasks.values())
+
+        await handlers.flush_pending_profile_updates(MagicMock())
+        await asyncio.gather(*waiting, return_exceptions=True)
+
+    mock_single.assert_awaited_once_with(4, 502, "Dan [ID: 4]")
+    mock_batch.assert_awaited_once_with(503, {5: "Eve [ID: 5]", 6: "Fay [ID: 6]"})
+    assert all(task.cancelled() for task in waiting)
+    assert not handlers._pending_profile_updates
+    assert not handlers._profile_flush_tasks
+
+
+async def test_shutdown_flush_waits_for_in_flight_batch(monkeypatch, mock_gemini, mock_memory):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_batch(users, recent_history):
+        started.set()
+        release.wait(5)
+        return {5: [{"fact": "Eve sails", "scope": "user"}]}
+
+    mock_gemini.extract_facts_batch.side_effect = slow_batch
+    mock_gemini.embed_text.return_value = [0.1, 0.2]
+    mock_memory.get_user_facts_bulk.return_value = {5: [], 6: []}
+    monkeypatch.setattr(handlers, "PROFILE_UPDATE_BATCH_DELAY", 0)
+    handlers._schedule_profile_update(5, 504, "Eve [ID: 5]")
+    handlers._schedule_profile_update(6, 504, "Fay [ID: 6]")
+    assert await asyncio.to_thread(started.wait, 5)
+    assert not handlers._profile_flush_tasks  # past its delay, blocked on Gemini
+
+    shutdown = asyncio.create_task(handlers.flush_pending_profile_updates(MagicMock()))
+    await asyncio.sleep(0.05)
+    assert not shutdown.done()
+    release.set()
+    await shutdown
+
+    mock_memory.upsert_user_facts.assert_called_once()
+    assert mock_memory.upsert_user_facts.call_args.kwargs["user_id"] == 5
+    assert not handlers._active_profile_flushes
+
+
+async def test_batch_profile_update_stores_facts_per_user(mock_gemini, mock_memory):
+    mock_gemini.embed_text.return_value = [0.1, 0.2]
+    mock_gemini.extract_facts_batch.return_value = {
+        1: [{"fact": "Alice is a nurse", "scope": "user"}],
+        2: [{"fact": "This chat speaks Ukrainian", "scope": "chat"}],
+    }
+    mock_memory.get_user_facts_bulk.return_value = {1: ["Alice likes tea"], 2: []}
+    await handlers._update_user_profiles_batch(
+        502, {1: "Alice [ID: 1]", 2: "Bob [ID: 2]"}
+    )
+
+    mock_memory.get_user_facts_bulk.assert_called_once_with([1, 2], limit=40)
+    mock_memory.get_user_facts.assert_not_called()
+    mock_gemini.extract_facts_batch.assert_called_once()
+    users_arg = mock_gemini.extract_facts_batch.call_args.kwargs["users"]
+    assert users_arg == [
+        (1, "Alice [ID: 1]", ["Alice likes tea"]),
+        (2, "Bob [ID: 2]", []),
+    ]
+    mock_memory.upsert_user_facts.assert_called_once()
+    assert mock_memory.upsert_user_facts.call_args.kwargs["user_id"] == 1
+    mock_memory.upsert_chat_facts.assert_called_once()
+    assert mock_memory.upsert_chat_facts.call_args.kwargs["chat_id"] == 502
+
+
+@pytest.mark.parametrize(
+    "is_private,is_reply_to_bot,is_mention,expected",
+    [
+        (True, False, False, True),
+        (False, False, True, True),
+        (False, True, False, True),
+        (False, False, False, False),
+        (False, True, True, True),
+    ],
+    ids=["private", "mention", "reply", "unaddressed", "reply_and_mention"],
+)
+async def test_should_respond(
+    is_private, is_reply_to_bot, is_mention, expected, mock_gemini, mock_memory, update_factory, context_factory,
+):
+    text = "@testbot how are you?" if is_mention else "how are you?"
+    update = update_factory(text, chat_id=90)
+    update.message.chat.type = "private" if is_private else "group"
+    if is_reply_to_bot:
+        update.message.reply_to_message = SimpleNamespace(
+            from_user=SimpleNamespace(username="testbot")
+        )
+    context = context_factory(bot_username="testbot")
+    mock_gemini.ask.return_value = ("Fine, thanks!", False)
+
+    await handlers.handle_message(update, context)
+
+    assert mock_gemini.ask.called is expected
+    if expected:
+        update.message.reply_text.assert_called_once_with("Fine, thanks!")
+    else:
+        update.message.reply_text.assert_not_called()
+
+
+async def test_interval_message_schedules_background_profile_update(
+    mock_memory, update_factory, context_factory,
+):
+    update = update_factory("nice weather today", chat_id=91, first_name="Ivy")
+    update.message.from_user.id = 913
+    context = context_factory()
+    mock_memory.increment_message_count.return_value = handlers.MEMORY_UPDATE_INTERVAL
+
+    with patch("bot.handlers._schedule_profile_update") as mock_schedule:
+        await handlers.handle_message(update, context)
+
+    mock_schedule.assert_called_once_with(913, 91, "Ivy [ID: 913]")
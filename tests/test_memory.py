@@ -1,44 +1,55 @@
+import sqlite3
+
 import pytest
-from bot.memory import UserMemory
-from alembic.config import Config
-from alembic import command
+from bot.memory import (
+    UserMemory,
+    _clamp01,
+    _now_iso,
+    _parse_ts,
+    _top_k,
+)
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-import sqlite3
+import math
 
-@pytest.fixture
-def mem(tmp_path):
-    db_path = str(tmp_path / "test.db")
-    
-    # Run alembic migrations specifically on this temporary DB
-    alembic_cfg = Config("alembic.ini")
-    alembic_cfg.set_main_option("sqlalchemy.url", f"sqlite:///{db_path}")
-    command.upgrade(alembic_cfg, "head")
-    
-    return UserMemory(db_path=db_path)
+import numpy as np
 
+_FROZEN_NOW = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+_TWO_HOURS_AGO = (_FROZEN_NOW - timedelta(hours=2)).isoformat()
 
-def test_first_message_count_is_one(mem):
-    count = mem.increment_message_count(user_id=1, chat_id=100, username="alice", first_name="Alice")
-    assert count == 1
 
+class _FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return _FROZEN_NOW
 
-def test_message_count_accumulates(mem):
-    mem.increment_message_count(1, 100, "alice", "Alice")
-    mem.increment_message_count(1, 100, "alice", "Alice")
-    count = mem.increment_message_count(1, 100, "alice", "Alice")
-    assert count == 3
 
+@pytest.fixture
+def frozen_now(monkeypatch):
+    """Pin bot.memory's clock so timestamp-based scoring is deterministic."""
+    monkeypatch.setattr("bot.memory.datetime", _FrozenDatetime)
+    return _FROZEN_NOW
 
-def test_different_users_have_independent_counts(mem):
-    mem.increment_message_count(1, 100, "alice", "Alice")
-    count = mem.increment_message_count(2, 100, "bob", "Bob")
-    assert count == 1
 
+_ALICE_100 = (1, 100, "alice", "Alice")
+_ALICE_200 = (1, 200, "alice", "Alice")
+_BOB_100 = (2, 100, "bob", "Bob")
 
-def test_same_user_different_chats_share_count(mem):
-    mem.increment_message_count(1, 100, "alice", "Alice")
-    count = mem.increment_message_count(1, 200, "alice", "Alice")
-    assert count == 2  # global count accumulates across chats
+
+@pytest.mark.parametrize(
+    "calls,expected",
+    [
+        ([_ALICE_100], 1),
+        ([_ALICE_100] * 3, 3),
+        ([_ALICE_100, _BOB_100], 1),
+        ([_ALICE_100, _ALICE_200], 2),  # global count accumulates across chats
+    ],
+    ids=["first", "accumulates", "independent_users", "shared_across_chats"],
+)
+def test_increment_message_count(mem, calls, expected):
+    for args in calls:
+        count = mem.increment_message_count(*args)
+    assert count == expected
 
 
 def test_get_profile_unknown_user_returns_empty(mem):
@@ -71,6 +82,12 @@ def test_get_chat_members_empty_chat_returns_empty(mem):
     assert mem.get_chat_members(chat_id=999) == []
 
 
+def test_connection_rejects_use_from_another_thread(mem):
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        with pytest.raises(sqlite3.ProgrammingError):
+            pool.submit(mem.get_profile, 1).result()
+
+
 def test_search_profiles_by_embedding(mem):
     mem.increment_message_count(1, 100, "alice", "Alice")
     mem.increment_message_count(2, 100, "bob", "Bob")
@@ -95,6 +112,13 @@ def test_search_profiles_by_embedding_empty_or_invalid(mem):
     assert mem.search_profiles_by_embedding([1.0, 0.0]) == []
 
 
+@pytest.mark.parametrize("query", [[], None], ids=["empty", "none"])
+def test_searches_return_empty_for_missing_query(mem, query):
+    assert mem.search_profiles_by_embedding(query) == []
+    assert mem.find_similar_facts(scope="user", user_id=1, query_embedding=query) == []
+    assert mem.search_facts_by_embedding(query, chat_id=100, asking_user_id=1) == []
+
+
 def test_upsert_user_facts_and_search_by_embedding(mem):
     mem.increment_message_count(1, 100, "alice", "Alice")
     mem.increment_message_count(2, 100, "bob", "Bob")
@@ -134,6 +158,27 @@ def test_upsert_user_facts_and_search_by_embedding(mem):
     assert "score" in results[0]
 
 
+def test_search_facts_skips_zero_and_wrong_dimension_embeddings(mem):
+    mem.increment_message_count(1, 100, "alice", "Alice")
+    mem.upsert_user_facts(
+        user_id=1,
+        chat_id=100,
+        facts=[
+            {"fact": "Alice sails.", "embedding": [1.0, 0.0]},
+            {"fact": "Zero vector.", "embedding": [0.0, 0.0]},
+            {"fact": "Wrong dimension.", "embedding": [1.0, 0.0, 0.0]},
+        ],
+    )
+
+    def search(query):
+        return mem.search_facts_by_embedding(
+            query_embedding=query, chat_id=100, asking_user_id=1, min_semantic=-1.0
+        )
+
+    assert [r["fact_text"] for r in search([1.0, 0.0])] == ["Alice sails."]
+    assert search([0.0, 0.0]) == []
+
+
 def test_search_facts_respects_cooldown(mem):
     mem.increment_message_count(1, 100, "alice", "Alice")
     mem.upsert_user_facts(
@@ -164,7 +209,35 @@ def test_search_facts_respects_cooldown(mem):
     assert second == []
 
 
-def test_search_facts_uses_recency_and_importance(mem):
+@pytest.mark.parametrize(
+    "last_used_at",
+    [_TWO_HOURS_AGO, "2024-01-01 10:00:00", "2024-01-01T10:00:00Z"],
+    ids=["aware", "naive", "zulu"],  # the latter two as outside writers (Datasette) store them
+)
+def test_search_facts_includes_after_cooldown_expires(mem, frozen_now, last_used_at):
+    mem.increment_message_count(1, 100, "alice", "Alice")
+    mem.upsert_user_facts(
+        user_id=1,
+        chat_id=100,
+        facts=[{"fact": "Alice bakes bread.", "importance": 0.5, "embedding": [1.0, 0.0]}],
+    )
+    with mem._conn as conn:
+        conn.execute("UPDATE memory_facts SET last_used_at = ?", (last_used_at,))
+        conn.commit()
+
+    def search(cooldown_seconds):
+        return mem.search_facts_by_embedding(
+            query_embedding=[1.0, 0.0],
+            chat_id=100,
+            asking_user_id=1,
+            cooldown_seconds=cooldown_seconds,
+        )
+
+    assert [r["fact_text"] for r in search(3600)] == ["Alice bakes bread."]
+    assert search(3 * 3600) == []
+
+
+def test_search_facts_uses_recency_and_importance(mem, frozen_now):
     mem.increment_message_count(1, 100, "alice", "Alice")
     mem.increment_message_count(2, 100, "bob", "Bob")
     mem.upsert_user_facts(
@@ -191,8 +264,8 @@ def test_search_facts_uses_recency_and_importance(mem):
             }
         ],
     )
-    with sqlite3.connect(mem.db_path) as conn:
-        old_ts = (datetime.now(timezone.utc) - timedelta(days=90)).isoformat()
+    with mem._conn as conn:
+        old_ts = (frozen_now - timedelta(days=90)).isoformat()
         conn.execute(
             "UPDATE memory_facts SET updated_at = ? WHERE fact_text = ?",
             (old_ts, "Bob likes abstract theory."),
@@ -214,34 +287,42 @@ def test_search_facts_uses_recency_and_importance(mem):
     assert mem.search_profiles_by_embedding([1.0, 0.0]) == []
 
 
-def test_find_similar_facts_returns_ranked_candidates(mem):
+_SOLAR = ("Alice plans to install 5 kW solar panels.", [1.0, 0.0])
+_CONCISE = ("Alice prefers concise replies.", [0.0, 1.0])
+_MIXED = ("Alice reads the news daily.", [0.6, 0.8])
+
+
+@pytest.mark.parametrize(
+    "saved,query,limit,min_semantic,expected",
+    [
+        ([_SOLAR, _CONCISE], [0.95, 0.05], 2, 0.35, [_SOLAR[0]]),
+        ([_SOLAR, _CONCISE, _MIXED], [0.95, 0.05], 3, 0.0, [_SOLAR[0], _MIXED[0], _CONCISE[0]]),
+        ([_SOLAR, _CONCISE, _MIXED], [0.95, 0.05], 1, 0.0, [_SOLAR[0]]),
+        ([_SOLAR], [0.0, 1.0], 3, 0.35, []),
+        ([], [1.0, 0.0], 3, 0.35, []),
+    ],
+    ids=["threshold", "ranked", "limit", "no_match", "empty"],
+)
+def test_find_similar_facts_returns_ranked_candidates(
+    mem, saved, query, limit, min_semantic, expected
+):
     mem.increment_message_count(1, 100, "alice", "Alice")
     mem.upsert_user_facts(
         user_id=1,
         chat_id=100,
         facts=[
-            {
-                "fact": "Alice plans to install 5 kW solar panels.",
-                "importance": 0.9,
-                "confidence": 0.9,
-                "embedding": [1.0, 0.0],
-            },
-            {
-                "fact": "Alice prefers concise replies.",
-                "importance": 0.5,
-                "confidence": 0.8,
-                "embedding": [0.0, 1.0],
-            },
+            {"fact": text, "importance": 0.5, "confidence": 0.8, "embedding": embedding}
+            for text, embedding in saved
         ],
     )
     similar = mem.find_similar_facts(
         scope="user",
         user_id=1,
-        query_embedding=[0.95, 0.05],
-        limit=2,
+        query_embedding=query,
+        limit=limit,
+        min_semantic=min_semantic,
     )
-    assert len(similar) == 1
-    assert similar[0]["fact_text"] == "Alice plans to install 5 kW solar panels."
+    assert [item["fact_text"] for item in similar] == expected
 
 
 def test_upsert_user_facts_updates_target_fact_without_duplicate(mem):
@@ -258,7 +339,7 @@ def test_upsert_user_facts_updates_target_fact_without_duplicate(mem):
             }
         ],
     )
-    with sqlite3.connect(mem.db_path) as conn:
+    with mem._conn as conn:
         row = conn.execute(
             "SELECT id FROM memory_facts WHERE fact_text = ?",
             ("Alice plans to install 5 kW solar panels.",),
@@ -283,7 +364,7 @@ def test_upsert_user_facts_updates_target_fact_without_duplicate(mem):
     facts = mem.get_user_facts(user_id=1, limit=10)
     assert "Alice plans to install around 2.5 kW solar panels." in facts
     assert "Alice plans to install 5 kW solar panels." not in facts
-    with sqlite3.connect(mem.db_path) as conn:
+    with mem._conn as conn:
         count = conn.execute(
             """
             SELECT COUNT(*) FROM memory_facts
@@ -308,7 +389,7 @@ def test_upsert_user_facts_deactivates_target_fact(mem):
             }
         ],
     )
-    with sqlite3.connect(mem.db_path) as conn:
+    with mem._conn as conn:
         row = conn.execute(
             "SELECT id FROM memory_facts WHERE fact_text = ?",
             ("Alice wants to move next month.",),
@@ -330,15 +411,105 @@ def test_upsert_user_facts_deactivates_target_fact(mem):
     assert mem.get_user_facts(user_id=1, limit=10) == []
 
 
-def test_get_user_facts_page_returns_paginated_results(mem):
+def test_embeddings_stored_as_float32_blob_and_legacy_json_still_read(mem):
     mem.increment_message_count(1, 100, "alice", "Alice")
-    # Insert 7 facts
-    for i in range(7):
-        mem.upsert_user_facts(
-            user_id=1,
-            chat_id=100,
-            facts=[{"fact": f"Fact number {i}", "importance": 0.5, "confidence": 0.8}],
+    mem.upsert_user_facts(
+        user_id=1,
+        chat_id=100,
+        facts=[
+            {"fact": "Alice rides a bike.", "embedding": [1.0, 0.0]},
+            {"fact": "Alice grows tomatoes.", "embedding": [0.0, 1.0]},
+        ],
+    )
+    with mem._conn as conn:
+        stored = conn.execute(
+            "SELECT typeof(embedding), length(embedding) FROM memory_facts WHERE fact_text = ?",
+            ("Alice rides a bike.",),
+        ).fetchone()
+        # Simulate a row written before embeddings were stored as BLOBs
+        conn.execute(
+            "UPDATE memory_facts SET embedding = ? WHERE fact_text = ?",
+            ("[0.0, 1.0]", "Alice grows tomatoes."),
         )
+    assert stored == ("blob", 8)
+
+    similar = mem.find_similar_facts(scope="user", user_id=1, query_embedding=[0.0, 1.0])
+    assert [item["fact_text"] for item in similar] == ["Alice grows tomatoes."]
+
+
+def test_embedding_index_tracks_own_and_external_writes(mem, migrated_db):
+    mem.increment_message_count(1, 100, "alice", "Alice")
+    mem.upsert_user_facts(
+        user_id=1, chat_id=100, facts=[{"fact": "Alice rides a bike.", "embedding": [1.0, 0.0]}]
+    )
+
+    def similar_texts():
+        found = mem.find_similar_facts(scope="user", user_id=1, query_embedding=[0.0, 1.0])
+        return [item["fact_text"] for item in found]
+
+    assert similar_texts() == []
+
+    # A write through another UserMemory instance bumps PRAGMA data_version
+    other = UserMemory(db_path=migrated_db)
+    try:
+        other.upsert_user_facts(
+            user_id=1, chat_id=100, facts=[{"fact": "Alice grows tomatoes.", "embedding": [0.0, 1.0]}]
+        )
+    finally:
+        other.close()
+    assert similar_texts() == ["Alice grows tomatoes."]
+
+    # Edits from an unrelated connection (e.g. Datasette) are picked up too
+    with sqlite3.connect(migrated_db) as conn:
+        conn.execute(
+            "UPDATE memory_facts SET embedding = ? WHERE fact_text = ?",
+            (b"\x00" * 8, "Alice grows tomatoes."),
+        )
+    assert similar_texts() == []
+
+    mem.upsert_user_facts(
+        user_id=1, chat_id=100, facts=[{"fact": "Alice rides a bike.", "embedding": [0.0, 1.0]}]
+    )
+    assert similar_texts() == ["Alice rides a bike."]
+
+
+def test_upsert_user_facts_batch_merges_repeated_and_renamed_texts(mem):
+    mem.increment_message_count(1, 100, "alice", "Alice")
+    mem.upsert_user_facts(user_id=1, chat_id=100, facts=[{"fact": "Alice owns a cat."}])
+    cat_id = mem.get_user_facts_page(user_id=1)[0][0]["id"]
+
+    mem.upsert_user_facts(
+        user_id=1,
+        chat_id=100,
+        facts=[
+            {"fact": "Alice skis.", "importance": 0.3, "embedding": [1.0, 0.0]},
+            {"fact": "Alice skis.", "importance": 0.9},
+            {"fact": "Alice owns two cats.", "action": "update_existing", "target_fact_id": cat_id},
+            {"fact": "Alice owns two cats.", "importance": 0.7},
+        ],
+    )
+
+    with mem._conn as conn:
+        rows = conn.execute(
+            "SELECT id, fact_text, importance, length(embedding) FROM memory_facts ORDER BY id"
+        ).fetchall()
+    assert rows[0] == (cat_id, "Alice owns two cats.", 0.7, None)
+    assert rows[1][1:] == ("Alice skis.", 0.9, 8)
+    assert len(rows) == 2
+
+
+def test_get_user_facts_page_returns_paginated_results(mem):
+    mem.increment_message_count(1, 100, "alice", "Alice")
+    # Insert 7 facts in one transaction; they share updated_at, so paging
+    # also exercises the id tie-break.
+    mem.upsert_user_facts(
+        user_id=1,
+        chat_id=100,
+        facts=[
+            {"fact": f"Fact number {i}", "importance": 0.5, "confidence": 0.8}
+            for i in range(7)
+        ],
+    )
 
     # Page 0 should have 5 facts (default page_size)
     facts_p0, total = mem.get_user_facts_page(user_id=1, page=0)
@@ -359,6 +530,9 @@ def test_get_user_facts_page_returns_paginated_results(mem):
     ids_p0 = {f["id"] for f in facts_p0}
     ids_p1 = {f["id"] for f in facts_p1}
     assert ids_p0.isdisjoint(ids_p1)
+    assert [f["fact_text"] for f in facts_p0 + facts_p1] == [
+        f"Fact number {i}" for i in reversed(range(7))
+    ]
 
 
 def test_get_user_facts_page_empty_user(mem):
@@ -367,6 +541,47 @@ def test_get_user_facts_page_empty_user(mem):
     assert total == 0
 
 
+def test_get_user_facts_bulk_matches_per_user_queries(mem):
+    mem.increment_message_count(1, 100, "alice", "Alice")
+    mem.increment_message_count(2, 100, "bob", "Bob")
+    mem.upsert_user_facts(
+        user_id=1, chat_id=100, facts=[{"fact": f"Alice fact {i}"} for i in range(4)]
+    )
+    mem.upsert_user_facts(user_id=2, chat_id=100, facts=[{"fact": "Bob fact"}])
+    mem.upsert_chat_facts(chat_id=100, facts=[{"fact": "Chat fact"}])
+
+    bulk = mem.get_user_facts_bulk([1, 2, 3], limit=3)
+
+    assert bulk == {
+        1: mem.get_user_facts(user_id=1, limit=3),
+        2: ["Bob fact"],
+        3: [],
+    }
+    assert len(bulk[1]) == 3
+    assert mem.get_user_facts_bulk([]) == {}
+
+
+def test_get_fact_by_id_scoped_to_owner_and_active(mem):
+    mem.increment_message_count(1, 100, "alice", "Alice")
+    mem.upsert_user_facts(
+        user_id=1,
+        chat_id=100,
+        facts=[{"fact": "Alice likes tea"}, {"fact": "Alice likes jazz"}],
+    )
+    facts, _ = mem.get_user_facts_page(user_id=1, page=0)
+    tea_id = next(f["id"] for f in facts if f["fact_text"] == "Alice likes tea")
+    jazz_id = next(f["id"] for f in facts if f["fact_text"] == "Alice likes jazz")
+    mem.upsert_user_facts(
+        user_id=1,
+        chat_id=100,
+        facts=[{"fact": "x", "action": "deactivate_existing", "target_fact_id": jazz_id}],
+    )
+
+    assert mem.get_fact_by_id(tea_id, user_id=1) == {"id": tea_id, "fact_text": "Alice likes tea"}
+    assert mem.get_fact_by_id(tea_id, user_id=2) is None
+    assert mem.get_fact_by_id(jazz_id, user_id=1) is None
+
+
 def test_delete_fact_removes_fact(mem):
     mem.increment_message_count(1, 100, "alice", "Alice")
     mem.upsert_user_facts(
@@ -435,7 +650,7 @@ def test_update_fact_text_changes_text_and_clears_embedding(mem):
     assert facts_after[0]["fact_text"] == "Alice prefers oranges"
 
     # Verify embedding was cleared
-    with sqlite3.connect(mem.db_path) as conn:
+    with mem._conn as conn:
         row = conn.execute(
             "SELECT embedding FROM memory_facts WHERE id = ?", (fact_id,)
         ).fetchone()
@@ -458,3 +673,67 @@ def test_update_fact_text_wrong_user_returns_false(mem):
     # Original text should remain
     facts_after, _ = mem.get_user_facts_page(user_id=1, page=0)
     assert facts_after[0]["fact_text"] == "Alice likes cats"
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [(0.5, 0.5), (-1.0, 0.0), (2.0, 1.0), (None, 0.0), ("bad", 0.0), ("0.3", 0.3)],
+)
+def test_clamp01(value, expected):
+    assert _clamp01(value) == expected
+
+
+def test_indexed_similarities_nan_for_unusable_rows(mem):
+    mem.increment_message_count(1, 100, "alice", "Alice")
+    mem.upsert_user_facts(
+        user_id=1,
+        chat_id=100,
+        facts=[
+            {"fact": "same", "embedding": [1.0, 0.0]},
+            {"fact": "mismatched", "embedding": [1.0, 0.0, 0.0]},
+            {"fact": "zero", "embedding": [0.0, 0.0]},
+            {"fact": "orthogonal", "embedding": [0.0, 2.0]},
+            {"fact": "opposite", "embedding": [-3.0, 0.0]},
+            {"fact": "garbage"},
+        ],
+    )
+    with mem._conn as conn:
+        ids = dict(conn.execute("SELECT fact_text, id FROM memory_facts").fetchall())
+        conn.execute("UPDATE memory_facts SET embedding = 'not json' WHERE fact_text = 'garbage'")
+    order = ["same", "mismatched", "zero", "orthogonal", "opposite", "garbage"]
+    row_ids = [ids[text] for text in order] + [999_999]  # last id doesn't exist
+
+    sims = mem._indexed_similarities("memory_facts", row_ids, [2.0, 0.0])
+
+    assert sims[0] == pytest.approx(1.0)
+    assert sims[3] == pytest.approx(0.0)
+    assert sims[4] == pytest.approx(-1.0)
+    assert [math.isnan(s) for s in sims] == [False, True, True, False, False, True, True]
+    for query in ([0.0, 0.0], []):
+        assert np.isnan(mem._indexed_similarities("memory_facts", row_ids, query)).all()
+    assert mem._indexed_similarities("memory_facts", [], [1.0, 0.0]).size == 0
+
+
+@pytest.mark.parametrize(
+    "scores,k,expected",
+    [
+        ([0.1, 0.9, 0.5, 0.7], 2, [1, 3]),
+        ([0.1, 0.9, 0.5], 5, [1, 2, 0]),
+        ([0.5, 0.8, 0.5, 0.5], 3, [1, 0, 2]),  # ties keep input order
+        ([0.3], 0, []),
+        ([], 3, []),
+    ],
+    ids=["partial", "k_exceeds_n", "ties", "zero_k", "empty"],
+)
+def test_top_k(scores, k, expected):
+    assert _top_k(np.asarray(scores, dtype=np.float32), k).tolist() == expected
+
+
+@pytest.mark.parametrize(
+    "ts", [None, "", "not-a-date", "2024-01-01T00:00:00", _now_iso()],
+    ids=["none", "empty", "invalid", "naive", "aware"],
+)
+def test_parse_ts_always_returns_aware_datetime(ts):
+    parsed = _parse_ts(ts)
+    assert isinstance(parsed, datetime)
+    assert parsed.tzinfo is not None
@@ -1,9 +1,26 @@
 import asyncio
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
+from cachetools import TTLCache
 from telegram import Update, Message, User, Chat, CallbackQuery
 from telegram.ext import ContextTypes
 
+from bot.memory_handlers import (
+    PENDING_EDIT_TTL_SECONDS,
+    _pending_edits,
+    handle_memory_callback,
+    handle_memory_command,
+    handle_memory_edit_reply,
+)
+
+# Resolve spec attribute lists once; passing a class to spec_set= re-runs dir() per mock.
+_USER_SPEC = dir(User)
+_CHAT_SPEC = dir(Chat)
+_MESSAGE_SPEC = dir(Message)
+_UPDATE_SPEC = dir(Update)
+_QUERY_SPEC = dir(CallbackQuery)
+_CONTEXT_SPEC = dir(ContextTypes.DEFAULT_TYPE)
+
 
 def make_update(
     text: str = "/memory",
@@ -13,29 +30,29 @@ def make_update(
     chat_type: str = "private",
     callback_data: str | None = None,
 ) -> Update:
-    user = MagicMock(spec=User)
+    user = MagicMock(spec_set=_USER_SPEC)
     user.first_name = first_name
     user.username = first_name.lower()
     user.id = user_id
 
-    chat = MagicMock(spec=Chat)
+    chat = MagicMock(spec_set=_CHAT_SPEC)
     chat.id = chat_id
     chat.type = chat_type
 
-    message = MagicMock(spec=Message)
+    message = MagicMock(spec_set=_MESSAGE_SPEC)
     message.text = text
     message.chat_id = chat_id
     message.from_user = user
     message.chat = chat
     message.reply_text = AsyncMock()
 
-    update = MagicMock(spec=Update)
+    update = MagicMock(spec_set=_UPDATE_SPEC)
     update.message = message
     update.effective_chat = chat
     update.effective_user = user
 
     if callback_data is not None:
-        query = MagicMock(spec=CallbackQuery)
+        query = MagicMock(spec_set=_QUERY_SPEC)
         query.data = callback_data
         query.answer = AsyncMock()
         query.edit_message_text = AsyncMock()
@@ -51,15 +68,12 @@ def make_update(
 
 
 def make_context(args: list[str] | None = None) -> ContextTypes.DEFAULT_TYPE:
-    context = MagicMock(spec=ContextTypes.DEFAULT_TYPE)
+    context = MagicMock(spec_set=_CONTEXT_SPEC)
     context.args = args or []
     return context
 
 
-@pytest.mark.asyncio
 async def test_memory_command_shows_facts():
-    from bot.memory_handlers import handle_memory_command
-
     update = make_update()
     context = make_context()
 
@@ -79,10 +93,7 @@ async def test_memory_command_shows_facts():
     assert keyboard.inline_keyboard[0][0].callback_data == "mem:view:42:10"
 
 
-@pytest.mark.asyncio
 async def test_memory_command_no_facts():
-    from bot.memory_handlers import handle_memory_command
-
     update = make_update()
     context = make_context()
 
@@ -96,10 +107,7 @@ async def test_memory_command_no_facts():
     assert "reply_markup" not in kwargs
 
 
-@pytest.mark.asyncio
 async def test_memory_command_private_chat_user_id_override():
-    from bot.memory_handlers import handle_memory_command
-
     # Admin Alice (10) checks memories of Bob (20)
     update = make_update(chat_type="private")
     context = make_context(args=["20"])
@@ -111,10 +119,7 @@ async def test_memory_command_private_chat_user_id_override():
     mock_memory.get_user_facts_page.assert_called_once_with(20, page=0)
 
 
-@pytest.mark.asyncio
 async def test_memory_command_group_chat_blocked():
-    from bot.memory_handlers import handle_memory_command
-
     # Alice (10) checks memories in group chat
     update = make_update(chat_type="supergroup", chat_id=200)
     context = make_context()
@@ -130,10 +135,7 @@ async def test_memory_command_group_chat_blocked():
     assert "direct messages" in args[0].lower()
 
 
-@pytest.mark.asyncio
 async def test_memory_callback_delete():
-    from bot.memory_handlers import handle_memory_callback
-
     update = make_update(callback_data="mem:del:42:10")
     context = make_context()
 
@@ -152,20 +154,28 @@ async def test_memory_callback_delete():
     assert "Deleted" in args[0]
 
 
-@pytest.mark.asyncio
-async def test_memory_callback_view():
-    from bot.memory_handlers import handle_memory_callback
+async def test_memory_callback_unknown_action_is_ignored():
+    update = make_update(callback_data="mem:bogus:42:10")
+
+    with patch("bot.memory_handlers.user_memory") as mock_memory:
+        await handle_memory_callback(update, make_context())
 
+    update.callback_query.answer.assert_called_once()
+    update.callback_query.edit_message_text.assert_not_called()
+    assert mock_memory.mock_calls == []
+
+
+async def test_memory_callback_view():
     update = make_update(callback_data="mem:view:42:10")
     context = make_context()
 
     with patch("bot.memory_handlers.user_memory") as mock_memory:
-        mock_memory.get_user_facts_page.return_value = (
-            [{"id": 42, "fact_text": "Alice is typing"}],
-            1,
-        )
+        mock_memory.get_fact_by_id.return_value = {"id": 42, "fact_text": "Alice is typing"}
         await handle_memory_callback(update, context)
 
+    mock_memory.get_fact_by_id.assert_called_once_with(42, 10)
+    mock_memory.get_user_facts_page.assert_not_called()
+
     update.callback_query.edit_message_text.assert_called_once()
     args, kwargs = update.callback_query.edit_message_text.call_args
     assert "Alice is typing" in args[0]
@@ -175,14 +185,7 @@ async def test_memory_callback_view():
     assert len(keyboard.inline_keyboard) == 2
 
 
-@pytest.mark.asyncio
 async def test_memory_edit_flow():
-    from bot.memory_handlers import (
-        handle_memory_callback,
-        handle_memory_edit_reply,
-        _pending_edits,
-    )
-    
     _pending_edits.clear()
 
     # 1. User taps Edit
@@ -215,9 +218,7 @@ async def test_memory_edit_flow():
     assert (1, 10) not in _pending_edits
 
 
-@pytest.mark.asyncio
 async def test_memory_edit_flow_ignores_normal_messages():
-    from bot.memory_handlers import handle_memory_edit_reply, _pending_edits
     _pending_edits.clear()
     
     update = make_update(text="Just chatting", chat_id=1, user_id=10)
@@ -227,3 +228,21 @@ async def test_memory_edit_flow_ignores_normal_messages():
     consumed = await handle_memory_edit_reply(update, context)
     assert consumed is False
     update.message.reply_text.assert_not_called()
+
+
+async def test_memory_edit_expires_after_ttl(monkeypatch):
+    clock = [0.0]
+    pending = TTLCache(maxsize=10, ttl=PENDING_EDIT_TTL_SECONDS, timer=lambda: clock[0])
+    monkeypatch.setattr("bot.memory_handlers._pending_edits", pending)
+
+    context = make_context()
+    await handle_memory_callback(make_update(callback_data="mem:edit:42:10"), context)
+    assert (1, 10) in pending
+
+    clock[0] += PENDING_EDIT_TTL_SECONDS + 1
+    update = make_update(text="Too late", chat_id=1, user_id=10)
+    with patch("bot.memory_handlers.user_memory") as mock_memory:
+        consumed = await handle_memory_edit_reply(update, context)
+
+    assert consumed is False
+    mock_memory.update_fact_text.assert_not_called()
@@ -48,6 +48,21 @@ def test_format_history_joins_with_newlines():
 def test_format_history_empty_chat():
     sm = SessionManager(max_messages=10)
     assert sm.format_history(999) == ""
+    assert sm._formatted == {}  # unknown chats are not memoized
+
+
+def test_format_history_reuses_result_until_next_message(monkeypatch):
+    sm = SessionManager(max_messages=10)
+    sm.add_message(1, "user", "Hi", author="Sasha")
+    first = sm.format_history(1)
+
+    # A rebuild would now come out empty; the memoized string must be returned
+    monkeypatch.setattr(sm, "_sessions", {})
+    assert sm.format_history(1) is first
+    monkeypatch.undo()
+
+    sm.add_message(1, "model", "Hey")
+    assert sm.format_history(1) == "[Sasha]: Hi\n[bot]: Hey"
 
 
 def test_separate_chats_dont_mix():